@@ -0,0 +1,691 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import re
+import threading
+import time
+import chess
+import chess.engine
+from cache import AnalysisCache, LRUCache, analysis_key, position_key
+from perf import log_event
+
+logger = logging.getLogger(__name__)
+
+MAIA_LIMIT = chess.engine.Limit(time=1)
+# Maia's policy is read from a one-node search, a single network evaluation
+POLICY_LIMIT = chess.engine.Limit(nodes=1)
+STOCKFISH_LIMIT = chess.engine.Limit(time=0.1)
+# Streaming Maia updates are published at most this often (the GUI runs at 30 fps)
+UPDATE_INTERVAL = 1 / 30
+
+# Speculative analysis of Maia's predicted replies while the user is on move:
+# how many replies to look at, and the engine seconds they may use in total
+PONDER_MOVES = 3
+PONDER_BUDGET = 4.0
+
+# Seconds paused() waits for a search to stop
+PAUSE_TIMEOUT = 5.0
+
+MAIA = "maia"
+STOCKFISH = "stockfish"
+
+
+class TimeControl:
+    """Search limits that adapt to the position, usable wherever a Limit is.
+
+    budget is the seconds a search normally gets. A search with a single
+    legal move only goes one ply deep. Otherwise it stops once the ranking
+    of its lines has not changed for stable_depths depths, though never
+    before minimum seconds, and at the budget. While the best score still
+    swings by more than swing pawns from one depth to the next it may carry
+    on up to extend times the budget.
+    """
+
+    def __init__(self, budget=1.0, minimum=0.1, stable_depths=3, swing=0.3, extend=2.0):
+        self.budget = budget
+        self.minimum = minimum
+        self.stable_depths = stable_depths
+        self.swing = swing
+        self.extend = extend
+
+    def __repr__(self):
+        # Part of the analysis cache keys
+        return (
+            f"TimeControl(budget={self.budget}, minimum={self.minimum}, "
+            f"stable_depths={self.stable_depths}, swing={self.swing}, "
+            f"extend={self.extend})"
+        )
+
+    def start(self, board):
+        return SearchClock(self, board)
+
+
+class SearchClock:
+    """Follows one search under a TimeControl; see should_stop()."""
+
+    def __init__(self, control, board):
+        self.control = control
+        self.started = time.perf_counter()
+        self.reason = None  # Why the search was stopped early
+        if board.legal_moves.count() == 1:
+            self.limit = chess.engine.Limit(depth=1)
+            self.reason = "single move"
+        else:
+            # The engine's own hard stop; should_stop() usually comes first
+            self.limit = chess.engine.Limit(time=control.budget * control.extend)
+        self._depth = 0
+        self._lines = {}  # multipv -> (first move, score) at the latest depth
+        self._rankings = []  # First moves in order, per completed depth
+        self._scores = []  # Best score per completed depth
+
+    def should_stop(self, info):
+        """Feed every info of the search; True once it has seen enough."""
+        depth = info.get("depth")
+        if depth is None or not info.get("pv") or "score" not in info:
+            return False
+        if depth > self._depth and self._lines:
+            self._rankings.append(tuple(move for move, _ in self._ranked()))
+            self._scores.append(self._ranked()[0][1])
+        self._depth = max(depth, self._depth)
+        score = info["score"].relative.score(mate_score=10000) / 100.0
+        self._lines[info.get("multipv", 1)] = (info["pv"][0], score)
+
+        elapsed = time.perf_counter() - self.started
+        control = self.control
+        if elapsed < control.minimum:
+            return False
+        swinging = (
+            len(self._scores) >= 2
+            and abs(self._scores[-1] - self._scores[-2]) > control.swing
+        )
+        recent = self._rankings[-control.stable_depths :]
+        if (
+            not swinging
+            and len(recent) == control.stable_depths
+            and len(set(recent)) == 1
+        ):
+            self.reason = "stable"
+            return True
+        if elapsed >= control.budget and not swinging:
+            self.reason = "budget"
+            return True
+        return False
+
+    def _ranked(self):
+        return [self._lines[multipv] for multipv in sorted(self._lines)]
+
+
+# The GUI's default limits: the same budgets as MAIA_LIMIT and STOCKFISH_LIMIT,
+# but usually spent only in part
+ADAPTIVE_MAIA_LIMIT = TimeControl(1.0)
+ADAPTIVE_STOCKFISH_LIMIT = TimeControl(0.1, minimum=0.02)
+
+
+def search(engine, board, limit, multipv=None):
+    """engine.analyse() that also takes a TimeControl as limit."""
+    if not isinstance(limit, TimeControl):
+        return engine.analyse(board, limit, multipv=multipv)
+    clock = limit.start(board)
+    with engine.analysis(board, clock.limit, multipv=multipv) as analysis:
+        for info in analysis:
+            if clock.should_stop(info):
+                stop_analysis(analysis)
+    return analysis.multipv if multipv else analysis.info
+
+
+def lines_from_infos(infos):
+    lines = []
+    for info in infos:
+        if not info.get("pv") or "score" not in info:
+            continue  # Search was stopped before this line was reported
+        score = info["score"].relative.score(mate_score=10000) / 100.0
+        lines.append((info["pv"], score))
+    return lines
+
+
+def best_moves_from_lines(lines):
+    return [(pv[0], score) for pv, score in lines]
+
+
+def get_best_moves(engine, board, num_moves=3, limit=MAIA_LIMIT):
+    result = search(engine, board, limit, multipv=num_moves)
+    return best_moves_from_lines(lines_from_infos(result))
+
+
+# lc0 VerboseMoveStats line: "info string e2e4  (322 ) N: 0 (+ 0) (P: 12.34%) ..."
+MOVE_STATS = re.compile(r"^(\S+)\s+\(\s*\d+\s*\)\s+N:.*?\(P:\s*([\d.]+)%\)")
+
+
+def get_policy(engine, board):
+    """Return Maia's move probabilities for board, most likely move first.
+
+    Reads the network's policy instead of searching: lc0 prints the prior of
+    every legal move with VerboseMoveStats, and one node is enough for that,
+    so this takes milliseconds instead of MAIA_LIMIT. The probabilities are
+    after lc0's policy softmax temperature.
+    """
+    policy = []
+    with engine.analysis(
+        board, POLICY_LIMIT, options={"VerboseMoveStats": True}
+    ) as analysis:
+        for info in analysis:
+            match = MOVE_STATS.match(info.get("string", ""))
+            if not match or match.group(1) == "node":  # The root's own line
+                continue
+            move, prior = match.groups()
+            policy.append((chess.Move.from_uci(move), round(float(prior) / 100, 4)))
+    policy.sort(key=lambda item: item[1], reverse=True)
+    return policy
+
+
+def get_policies(engines, boards):
+    """Return get_policy() for every board, in order.
+
+    The boards are shared out between the engines, each working through its
+    share on its own thread. Engines are separate processes, so their
+    one-node searches run at the same time and N positions take about
+    N / len(engines) searches' time.
+    """
+    policies = [None] * len(boards)
+
+    def run(offset, engine):
+        for i in range(offset, len(boards), len(engines)):
+            policies[i] = get_policy(engine, boards[i])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(engines)) as executor:
+        futures = [executor.submit(run, i, engine) for i, engine in enumerate(engines)]
+        for future in futures:
+            future.result()
+    return policies
+
+
+def probabilities_from_info(info, ply=30):
+    """Return (win, draw, loss) probabilities for the side to move.
+
+    Uses the engine's own win/draw/loss statistics when it reports them
+    (UCI_ShowWDL), otherwise Stockfish's WDL model for the score at this ply.
+    """
+    if "wdl" in info:
+        wdl = info["wdl"].relative
+    else:
+        wdl = info["score"].relative.wdl(ply=ply)
+    total = wdl.total()
+    win_prob = wdl.wins / total
+    draw_prob = wdl.draws / total
+    loss_prob = wdl.losses / total
+    logger.debug(
+        "Probabilities - Win: %.2f%%, Draw: %.2f%%, Lose: %.2f%%",
+        win_prob * 100,
+        draw_prob * 100,
+        loss_prob * 100,
+    )
+    return win_prob, draw_prob, loss_prob
+
+
+def evaluate_position(engine, board, limit=STOCKFISH_LIMIT):
+    info = search(engine, board, limit)
+    return probabilities_from_info(info, board.ply())
+
+
+def analyse_position(engine, board, num_moves=3, limit=MAIA_LIMIT):
+    """Get best moves and probabilities from a single multipv search.
+
+    probabilities is None if the engine does not report win/draw/loss, in
+    which case evaluate_position() has to provide them.
+    """
+    infos = search(engine, board, limit, multipv=num_moves)
+    probabilities = None
+    if infos and "wdl" in infos[0]:
+        probabilities = probabilities_from_info(infos[0], board.ply())
+    return best_moves_from_lines(lines_from_infos(infos)), probabilities
+
+
+def stop_analysis(analysis):
+    try:
+        analysis.stop()
+    except chess.engine.EngineError:
+        pass  # The engine died; the worker thread reports it
+
+
+def engine_name(engine):
+    try:
+        return engine.id.get("name")
+    except chess.engine.EngineError:
+        return None  # Dead engine, its searches fail before anything is cached
+
+
+class AnalysisWorker:
+    """Analyses positions on background threads so the frame loop never waits.
+
+    The GUI posts the current board with request() and reads the latest
+    result with latest(). Posting a new position stops the searches still
+    running for the old one. Maia lines and Stockfish evaluations are cached
+    by position, so revisiting a position (undo, restart, a transposition)
+    shows its results straight away without another search.
+
+    When the Maia engine reports win/draw/loss (UCI_ShowWDL), its search
+    provides the probabilities as well and Stockfish is not asked at all.
+    Whether it does is learnt from the first search with each engine, which
+    hands over to Stockfish if it does not. Until then, positions whose Maia
+    lines are already cached are evaluated by Stockfish, as are all positions
+    for engines without WDL.
+
+    Positions known_positions (a KnownPositions) has an answer for skip the
+    searches: tablebase hits need no engine at all, book hits only Stockfish
+    for the probabilities.
+
+    Maia and Stockfish each get their own thread. Maia's lines are published
+    while the search deepens, at most once per UPDATE_INTERVAL, so a first
+    suggestion appears long before the search ends. With maia_limit=None the
+    Maia search keeps going until the position changes. Either limit may be
+    a TimeControl, which ends searches early where more time would not
+    change the answer.
+
+    Once the current position is done, the engines are idle until the user
+    moves, so the worker ponders: it analyses the positions after Maia's top
+    ponder_moves predictions and only fills the caches with the results. If
+    the user plays one of them its analysis is already there. Pondering stops
+    after ponder_budget engine seconds, and as soon as a new position is
+    requested.
+
+    search_stats holds the latency, nodes and nps of the last search for the
+    requested position per engine ("maia", "stockfish"); every search,
+    speculative ones included, is also sent to the perf timing log.
+    """
+
+    def __init__(
+        self,
+        engine,
+        stockfish_engine,
+        num_moves=3,
+        cache_size=4096,
+        analysis_cache=None,
+        elo_rating=None,
+        maia_limit=MAIA_LIMIT,
+        stockfish_limit=STOCKFISH_LIMIT,
+        ponder_moves=PONDER_MOVES,
+        ponder_budget=PONDER_BUDGET,
+        known_positions=None,
+    ):
+        self.engine = engine
+        self.stockfish_engine = stockfish_engine
+        self.num_moves = num_moves
+        self.elo_rating = elo_rating
+        self.maia_limit = maia_limit
+        self.stockfish_limit = stockfish_limit
+        self.ponder_moves = ponder_moves
+        self.ponder_budget = ponder_budget
+        self.known_positions = known_positions
+        self.evaluation_cache = LRUCache(cache_size)
+        if analysis_cache is None:
+            analysis_cache = AnalysisCache(cache_size)
+        self.analysis_cache = analysis_cache
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._engine_locks = {MAIA: threading.Lock(), STOCKFISH: threading.Lock()}
+        self._generation = 0
+        self._pending = {MAIA: None, STOCKFISH: None}
+        self._current = {MAIA: None, STOCKFISH: None}
+        self._speculative = {MAIA: [], STOCKFISH: []}
+        self._ponder_spent = 0.0
+        self._requested_key = None
+        self._best_moves = []
+        self._probabilities = None
+        self._outstanding = 0  # Searches still due for the requested position
+        self._reports_wdl = {}  # Maia engine -> whether its searches give WDL
+        self.search_stats = {}
+        self._running = True
+        self._threads = [
+            threading.Thread(
+                target=self._run, args=(lane,), name=f"analysis-{lane}", daemon=True
+            )
+            for lane in (MAIA, STOCKFISH)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def request(self, board):
+        """Queue analysis of board, dropping any result for older positions.
+
+        Requesting the position that was last requested is a no-op.
+        """
+        key = position_key(board)
+        with self._wakeup:
+            if key == self._requested_key:
+                return
+            self._invalidate()
+            self._requested_key = key
+            job = (board.copy(), key, self._generation, False)
+            if self.known_positions and self._request_known(board, key, job):
+                return
+            maia_wdl = self._reports_wdl.get(self.engine)
+            self._probabilities = self.evaluation_cache.get(
+                self._evaluation_key(key, maia_wdl)
+            )
+            lines = self.analysis_cache.get(self._analysis_key(board))
+            if self._probabilities is None and self._stockfish_evaluates(
+                maia_wdl, lines is not None
+            ):
+                self._pending[STOCKFISH] = job
+                self._outstanding += 1
+            if lines is None or (self._probabilities is None and maia_wdl):
+                self._pending[MAIA] = job
+                self._outstanding += 1
+            else:
+                self._best_moves = best_moves_from_lines(lines)
+                self._queue_ponder(board, lines)
+            self._wakeup.notify_all()
+
+    def latest(self):
+        """Return (best_moves, probabilities) for the last requested position."""
+        with self._lock:
+            return self._best_moves, self._probabilities
+
+    def done(self):
+        """Whether latest() is final: every search for the position finished.
+
+        Never true with maia_limit=None, as Maia keeps refining its lines.
+        """
+        with self._lock:
+            return (
+                self.maia_limit is not None
+                and self._outstanding == 0
+                and bool(self._best_moves)
+                and self._probabilities is not None
+            )
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Stop searching and keep the engines idle, e.g. while swapping one.
+
+        An engine that does not stop within PAUSE_TIMEOUT is assumed to hang
+        and is not waited for.
+        """
+        with self._lock:
+            self._invalidate()
+        with contextlib.ExitStack() as stack:
+            for lane, lock in self._engine_locks.items():
+                if lock.acquire(timeout=PAUSE_TIMEOUT):
+                    stack.callback(lock.release)
+                else:
+                    logger.warning("%s engine did not stop searching", lane)
+            yield
+
+    def close(self):
+        with self._wakeup:
+            self._running = False
+            self._invalidate()
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=2)
+
+    def _invalidate(self):
+        # Caller holds self._lock
+        self._generation += 1
+        self._pending = {MAIA: None, STOCKFISH: None}
+        self._speculative = {MAIA: [], STOCKFISH: []}
+        self._ponder_spent = 0.0
+        self._outstanding = 0
+        self._requested_key = None
+        self._best_moves = []
+        self._probabilities = None
+        for analysis in self._current.values():
+            if analysis is not None:
+                stop_analysis(analysis)
+
+    def _run(self, lane):
+        while True:
+            with self._wakeup:
+                job = self._next_job(lane)
+                while self._running and job is None:
+                    self._wakeup.wait()
+                    job = self._next_job(lane)
+                if not self._running:
+                    return
+            board, key, generation, speculative = job
+
+            start = time.perf_counter()
+            with self._engine_locks[lane]:
+                try:
+                    if lane == MAIA:
+                        self._analyse(board, key, generation, speculative)
+                    else:
+                        self._evaluate(board, key, generation, speculative)
+                except (chess.engine.EngineError, asyncio.TimeoutError) as e:
+                    logger.warning("Analysis failed: %s", e)
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                if speculative:
+                    self._ponder_spent += time.perf_counter() - start
+                else:
+                    self._outstanding -= 1
+
+    def _next_job(self, lane):
+        # Caller holds self._lock. The requested position always comes first.
+        job = self._pending[lane]
+        if job is not None:
+            self._pending[lane] = None
+            return job
+        if self._speculative[lane] and self._ponder_spent < self.ponder_budget:
+            board, key = self._speculative[lane].pop(0)
+            return board, key, self._generation, True
+        return None
+
+    def _request_known(self, board, key, job):
+        # Caller holds self._lock. Returns whether board was a known position.
+        known = self.known_positions.lookup(board, self.num_moves)
+        if known is None:
+            return False
+        self._best_moves, self._probabilities = known
+        if self._probabilities is None:
+            # A book move: Stockfish still provides the probabilities
+            self._probabilities = self.evaluation_cache.get(key)
+            if self._probabilities is None:
+                self._pending[STOCKFISH] = job
+                self._outstanding += 1
+                self._wakeup.notify_all()
+        return True
+
+    def _queue_ponder(self, board, lines):
+        # Caller holds self._lock
+        maia_wdl = self._reports_wdl.get(self.engine)
+        for pv, _ in lines[: self.ponder_moves]:
+            reply = board.copy()
+            reply.push(pv[0])
+            key = position_key(reply)
+            cached = self._analysis_key(reply) in self.analysis_cache
+            if not cached:
+                self._speculative[MAIA].append((reply, key))
+            if self._stockfish_evaluates(maia_wdl, cached):
+                if key not in self.evaluation_cache:
+                    self._speculative[STOCKFISH].append((reply, key))
+
+    def _stockfish_evaluates(self, maia_wdl, lines_cached):
+        # Stockfish gives the probabilities for engines without WDL, and for
+        # engines not tried yet when no Maia search is due to find out.
+        # Otherwise Maia's search gives them, or decides in _check_wdl().
+        return maia_wdl is False or (maia_wdl is None and lines_cached)
+
+    def _evaluation_key(self, key, maia_wdl):
+        # Maia's probabilities depend on the level, Stockfish's do not
+        if maia_wdl:
+            return key, engine_name(self.engine), self.elo_rating
+        return key
+
+    def _analysis_key(self, board):
+        return analysis_key(
+            board,
+            engine_name(self.engine),
+            self.elo_rating,
+            self.num_moves,
+            self.maia_limit,
+        )
+
+    def _analyse(self, board, key, generation, speculative=False):
+        limit, clock = self._clock(self.maia_limit, board)
+        analysis = self._start(
+            MAIA, self.engine, board, limit, self.num_moves, generation
+        )
+        if analysis is None:
+            return
+        started = time.perf_counter()
+        stopping = False
+        first_line = None
+        checked_wdl = False
+        last_update = 0.0
+        try:
+            with analysis:
+                for info in analysis:
+                    if first_line is None and "pv" in info:
+                        first_line = time.perf_counter() - started
+                    if not checked_wdl and "score" in info:
+                        checked_wdl = True
+                        self._check_wdl(board, key, generation, speculative, info)
+                    now = time.monotonic()
+                    if not speculative and now - last_update >= UPDATE_INTERVAL:
+                        last_update = now
+                        self._publish(analysis, board, generation)
+                    if clock and not stopping and clock.should_stop(info):
+                        stopping = True
+                        stop_analysis(analysis)
+        finally:
+            self._finish(MAIA)
+        if speculative:
+            lines = lines_from_infos(analysis.multipv)
+            with self._lock:
+                if generation != self._generation:
+                    return
+        else:
+            lines = self._publish(analysis, board, generation)
+            if lines is None:
+                return
+        # Only complete searches are cached, never ones cut short
+        if self.maia_limit is not None:
+            self.analysis_cache.put(self._analysis_key(board), lines)
+            if "wdl" in analysis.info:
+                with self._lock:
+                    self.evaluation_cache.put(
+                        self._evaluation_key(key, True),
+                        probabilities_from_info(analysis.info, board.ply()),
+                    )
+        self._record_search(
+            MAIA,
+            analysis.info,
+            started,
+            speculative,
+            first_line_ms=None if first_line is None else round(first_line * 1000, 1),
+            stopped=clock.reason if clock else None,
+        )
+        if not speculative:
+            with self._wakeup:
+                if generation == self._generation:
+                    self._queue_ponder(board, lines)
+                    self._wakeup.notify_all()
+
+    def _check_wdl(self, board, key, generation, speculative, info):
+        # Called with the first scored info of a Maia search. The first time
+        # an engine turns out to give no WDL, Stockfish takes over.
+        reports_wdl = "wdl" in info
+        with self._wakeup:
+            known = self._reports_wdl.get(self.engine)
+            self._reports_wdl[self.engine] = reports_wdl
+            if known is not None or reports_wdl or generation != self._generation:
+                return
+            if key in self.evaluation_cache:
+                if not speculative:
+                    self._probabilities = self.evaluation_cache.get(key)
+                return
+            if speculative:
+                self._speculative[STOCKFISH].append((board, key))
+            else:
+                self._pending[STOCKFISH] = (board, key, generation, False)
+                self._outstanding += 1
+            self._wakeup.notify_all()
+
+    def _evaluate(self, board, key, generation, speculative=False):
+        limit, clock = self._clock(self.stockfish_limit, board)
+        analysis = self._start(
+            STOCKFISH, self.stockfish_engine, board, limit, None, generation
+        )
+        if analysis is None:
+            return
+        started = time.perf_counter()
+        try:
+            with analysis:
+                if clock is not None:
+                    for info in analysis:
+                        if clock.should_stop(info):
+                            stop_analysis(analysis)
+                            break
+                analysis.wait()
+        finally:
+            self._finish(STOCKFISH)
+        info = analysis.info
+        with self._lock:
+            if generation != self._generation or "score" not in info:
+                return
+        probabilities = probabilities_from_info(info, board.ply())
+        with self._lock:
+            self.evaluation_cache.put(key, probabilities)
+            if generation == self._generation and not speculative:
+                self._probabilities = probabilities
+        self._record_search(
+            STOCKFISH,
+            info,
+            started,
+            speculative,
+            stopped=clock.reason if clock else None,
+        )
+
+    def _clock(self, limit, board):
+        # The engine limit for a search, and its SearchClock under a TimeControl
+        if isinstance(limit, TimeControl):
+            clock = limit.start(board)
+            return clock.limit, clock
+        return limit, None
+
+    def _start(self, lane, engine, board, limit, multipv, generation):
+        # Returns None if a newer position was requested in the meantime. The
+        # engine is called outside self._lock so that a stuck engine cannot
+        # block request() on the GUI thread.
+        with self._lock:
+            if generation != self._generation:
+                return None
+        analysis = engine.analysis(board, limit, multipv=multipv)
+        with self._lock:
+            self._current[lane] = analysis
+            if generation != self._generation:
+                stop_analysis(analysis)
+        return analysis
+
+    def _finish(self, lane):
+        with self._lock:
+            self._current[lane] = None
+
+    def _record_search(self, lane, info, started, speculative, **fields):
+        stats = {
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "depth": info.get("depth"),
+            "nodes": info.get("nodes"),
+            "nps": info.get("nps"),
+            **fields,
+        }
+        if not speculative:
+            self.search_stats[lane] = stats
+        log_event("search", engine=lane, speculative=speculative, **stats)
+
+    def _publish(self, analysis, board, generation):
+        # Returns None if the lines belong to a position no longer requested
+        lines = lines_from_infos(analysis.multipv)
+        probabilities = None
+        if "wdl" in analysis.info:
+            probabilities = probabilities_from_info(analysis.info, board.ply())
+        with self._lock:
+            if generation != self._generation:
+                return None
+            self._best_moves = best_moves_from_lines(lines)
+            if probabilities is not None:
+                self._probabilities = probabilities
+        return lines
@@ -0,0 +1,564 @@
+"""Serve Maia and Stockfish analysis to several GUIs from one set of engines.
+
+The server owns one bounded MaiaEnginePool, one Stockfish and one analysis
+cache, and answers requests over a Unix socket or a localhost TCP port. Each
+GUI started with --server is a thin client: it opens the window but no
+engines.
+
+    python analysis_server.py --listen 127.0.0.1:7531 --max-engines 3
+    python analysis_server.py --listen /tmp/maia.sock --lc0 "python fake_engine.py"
+    python maia_chess.py --server 127.0.0.1:7531
+
+The protocol is one JSON object per line in each direction:
+
+    -> {"id": 7, "fen": "...", "elo": 1500, "num_moves": 3}
+    <- {"id": 7, "best_moves": [["e2e4", 0.41], ...], "probabilities": [0.4, 0.45, 0.15]}
+    <- {"id": 7, "superseded": true}
+    <- {"id": 7, "error": "..."}
+    -> {"stats": true}
+    <- {"stats": {"sessions": 2, "searches": 40, "batched": 3, ...}}
+
+Every connection is a session. A session has at most one position waiting:
+sending a new one answers the old one with "superseded", as the GUI only
+cares about the position on the board. Sessions take turns for the engines
+(round robin), so one busy client cannot starve the others, and sessions
+asking for the same position at the same level share a single search.
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import chess
+from analysis import (
+    MAIA_LIMIT,
+    STOCKFISH_LIMIT,
+    analyse_position,
+    best_moves_from_lines,
+    evaluate_position,
+)
+from cache import AnalysisCache, LRUCache, analysis_key, position_key
+from known_positions import KnownPositions
+from engines import (
+    MAIA_ELOS,
+    STOCKFISH_COMMAND,
+    MaiaEnginePool,
+    maia_command,
+    quit_engine,
+    start_stockfish,
+)
+from perf import log_event
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "127.0.0.1:7531"
+
+
+def parse_address(address):
+    """Return (host, port) for "host:port", otherwise address as a socket path."""
+    host, _, port = address.rpartition(":")
+    if port.isdigit() and not address.startswith(("/", ".")):
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+class Job:
+    """One search, shared by every session waiting for the same position."""
+
+    def __init__(self, key, board, elo_rating, num_moves):
+        self.key = key
+        self.board = board
+        self.elo_rating = elo_rating
+        self.num_moves = num_moves
+        self.session = None  # Whose turn in the round robin it waits for
+        self.running = False
+        self.waiters = []  # (session, future)
+
+
+class AnalysisServer:
+    """Schedules analysis requests from many sessions onto shared engines.
+
+    At most `workers` searches run at once, and never two on one engine.
+    Maia's lines and the probabilities are cached by position and level;
+    when the Maia engines report win/draw/loss Stockfish is not asked.
+    Tablebase positions in known_positions are answered without a search,
+    and so are finished games, with no moves and the result as
+    probabilities.
+    """
+
+    def __init__(
+        self,
+        engine_pool,
+        stockfish_engine,
+        analysis_cache=None,
+        workers=2,
+        maia_limit=MAIA_LIMIT,
+        stockfish_limit=STOCKFISH_LIMIT,
+        cache_size=4096,
+        known_positions=None,
+    ):
+        self.engine_pool = engine_pool
+        self.stockfish_engine = stockfish_engine
+        if analysis_cache is None:
+            analysis_cache = AnalysisCache(cache_size)
+        self.analysis_cache = analysis_cache
+        self.evaluation_cache = LRUCache(cache_size)
+        self.workers = workers
+        self.maia_limit = maia_limit
+        self.stockfish_limit = stockfish_limit
+        self.known_positions = known_positions
+        self.stats = collections.Counter()
+        self._sessions = itertools.count(1)
+        self._connected = set()
+        self._queue = collections.OrderedDict()  # session -> Job, in turn order
+        self._jobs = {}  # key -> Job, queued or running
+        self._waiting = {}  # session -> (Job, future) it is waiting for
+        self._reports_wdl = {}  # Elo -> whether Maia's searches give WDL
+        self._engine_locks = {}
+        self._changed = None  # Created on the event loop in serve()
+
+    async def serve(self, address=DEFAULT_ADDRESS, ready=None):
+        self._changed = asyncio.Condition()
+        self._engine_locks = collections.defaultdict(asyncio.Lock)
+        workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        target = parse_address(address)
+        if isinstance(target, tuple):
+            server = await asyncio.start_server(self._handle, *target)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(target)  # Left behind by a server that was killed
+            server = await asyncio.start_unix_server(self._handle, target)
+        logger.info("Serving analysis on %s", address)
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def submit(self, session, board, elo_rating, num_moves=3):
+        """Return (best_moves, probabilities) for board.
+
+        Returns None if the session submits another position before this one
+        got its turn or shared search.
+        """
+        self._detach(session)
+        outcome = board.outcome()
+        if outcome is not None:
+            # Nothing to search; the side to move has lost or it is a draw
+            self.stats["game_over"] += 1
+            if outcome.winner is None:
+                return [], (0.0, 1.0, 0.0)
+            return [], (0.0, 0.0, 1.0)
+        known = self.known_positions and self.known_positions.lookup(board, num_moves)
+        if known and known[1] is not None:
+            self.stats["tablebase_hits"] += 1
+            return known
+        cached = self._cached(board, elo_rating, num_moves)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+        key = (position_key(board), elo_rating, num_moves)
+        future = asyncio.get_running_loop().create_future()
+        job = self._jobs.get(key)
+        if job is None:
+            job = self._jobs[key] = Job(key, board.copy(), elo_rating, num_moves)
+            job.session = session
+            self._queue[session] = job
+        else:
+            self.stats["batched"] += 1
+        job.waiters.append((session, future))
+        self._waiting[session] = (job, future)
+        async with self._changed:
+            self._changed.notify()
+        try:
+            return await future
+        finally:
+            if self._waiting.get(session, (None, None))[1] is future:
+                del self._waiting[session]
+
+    def snapshot(self):
+        return {
+            "sessions": len(self._connected),
+            "queued": len(self._queue),
+            "running": sum(job.running for job in self._jobs.values()),
+            "engines": len(self.engine_pool),
+            **self.stats,
+        }
+
+    def _detach(self, session):
+        # Drop the session's outstanding request, answering it with None
+        entry = self._waiting.pop(session, None)
+        if entry is None:
+            return
+        job, future = entry
+        job.waiters = [waiter for waiter in job.waiters if waiter[1] is not future]
+        if not future.done():
+            future.set_result(None)
+            self.stats["superseded"] += 1
+        if job.running or job.session != session:
+            return
+        del self._queue[session]
+        if job.waiters:
+            # Still wanted by a session that joined it: wait for that one's turn
+            job.session = job.waiters[0][0]
+            self._queue[job.session] = job
+        else:
+            del self._jobs[job.key]
+
+    async def _work(self):
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._queue)
+                _, job = self._queue.popitem(last=False)
+            job.running = True
+            result = None  # Stays None only if the server is shutting down
+            try:
+                result = await self._analyse(job)
+            except Exception as e:
+                logger.warning("Analysis failed: %r", e)
+                result = e
+            finally:
+                del self._jobs[job.key]
+                for _, future in job.waiters:
+                    if future.done():
+                        continue
+                    if result is None:
+                        future.cancel()
+                    elif isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    async def _analyse(self, job):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+
+        async def maia():
+            async with self._engine_locks[job.elo_rating]:
+                return await loop.run_in_executor(None, self._search_maia, job)
+
+        async def stockfish():
+            async with self._engine_locks["stockfish"]:
+                return await loop.run_in_executor(
+                    None,
+                    evaluate_position,
+                    self.stockfish_engine,
+                    job.board,
+                    self.stockfish_limit,
+                )
+
+        self.stats["searches"] += 1
+        if self._reports_wdl.get(job.elo_rating) is False:
+            (best_moves, _), probabilities = await asyncio.gather(maia(), stockfish())
+        else:
+            best_moves, probabilities = await maia()
+            self._reports_wdl[job.elo_rating] = probabilities is not None
+            if probabilities is None:
+                probabilities = await stockfish()
+        self.analysis_cache.put(
+            self._analysis_key(job.board, job.elo_rating, job.num_moves),
+            [([move], score) for move, score in best_moves],
+        )
+        self.evaluation_cache.put(
+            (position_key(job.board), job.elo_rating), probabilities
+        )
+        log_event(
+            "server_search",
+            elo=job.elo_rating,
+            sessions=len(job.waiters),
+            latency_ms=round((time.perf_counter() - started) * 1000, 2),
+        )
+        return best_moves, probabilities
+
+    def _search_maia(self, job):
+        # Runs on an executor thread
+        with self.engine_pool.lease(job.elo_rating) as engine:
+            return analyse_position(engine, job.board, job.num_moves, self.maia_limit)
+
+    def _cached(self, board, elo_rating, num_moves):
+        probabilities = self.evaluation_cache.get((position_key(board), elo_rating))
+        if probabilities is None:
+            return None
+        lines = self.analysis_cache.get(
+            self._analysis_key(board, elo_rating, num_moves)
+        )
+        if lines is None:
+            return None
+        return best_moves_from_lines(lines), probabilities
+
+    def _analysis_key(self, board, elo_rating, num_moves):
+        # The command line stands in for the engine name, which is only known
+        # once the engine for this level has started
+        command = maia_command(
+            elo_rating, self.engine_pool.lc0, self.engine_pool.weights
+        )
+        return analysis_key(
+            board, " ".join(command), elo_rating, num_moves, self.maia_limit
+        )
+
+    async def _handle(self, reader, writer):
+        session = next(self._sessions)
+        self._connected.add(session)
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(
+                    self._answer(session, line, writer, write_lock)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            self._connected.discard(session)
+            self._detach(session)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, session, line, writer, write_lock):
+        response = {}
+        try:
+            message = json.loads(line)
+            response["id"] = message.get("id")
+            if message.get("stats"):
+                response["stats"] = self.snapshot()
+            else:
+                elo_rating = int(message.get("elo", 1500))
+                if elo_rating not in MAIA_ELOS:
+                    raise ValueError(f"No Maia network for Elo {elo_rating}")
+                board = chess.Board(message["fen"])
+                num_moves = int(message.get("num_moves", 3))
+                try:
+                    result = await self.submit(session, board, elo_rating, num_moves)
+                except Exception as e:
+                    response["error"] = f"Analysis failed: {e!r}"
+                else:
+                    if result is None:
+                        response["superseded"] = True
+                    else:
+                        best_moves, probabilities = result
+                        response["best_moves"] = [
+                            [move.uci(), score] for move, score in best_moves
+                        ]
+                        response["probabilities"] = probabilities
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            response["error"] = f"Bad request: {e}"
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            with contextlib.suppress(ConnectionError):
+                await writer.drain()
+
+
+class RemoteAnalysisWorker:
+    """AnalysisWorker stand-in that asks an analysis server.
+
+    Same interface as AnalysisWorker for the GUI: request(), latest(), done(),
+    paused() and close(). Answers are kept in analysis_cache and
+    evaluation_cache, so revisited positions do not go back to the server.
+    search_stats["maia"] is the round trip of the last answered request.
+    """
+
+    def __init__(self, address, elo_rating=1500, num_moves=3, cache_size=4096):
+        self.elo_rating = elo_rating
+        self.num_moves = num_moves
+        self.analysis_cache = AnalysisCache(cache_size)
+        self.evaluation_cache = LRUCache(cache_size)
+        self.search_stats = {}
+        self.known_positions = None  # Looked up by the server
+        target = parse_address(address)
+        if isinstance(target, tuple):
+            self._socket = socket.create_connection(target)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(target)
+        self._reader = self._socket.makefile("rb")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sent = {}  # id -> (board, elo, time sent)
+        self._latest_id = None
+        self._requested_key = None
+        self._best_moves = []
+        self._probabilities = None
+        self._thread = threading.Thread(
+            target=self._run, name="analysis-client", daemon=True
+        )
+        self._thread.start()
+
+    def request(self, board):
+        """Ask for board unless it is the position that was last requested."""
+        key = (position_key(board), self.elo_rating)
+        with self._lock:
+            if key == self._requested_key:
+                return
+            self._requested_key = key
+            self._latest_id = None
+            cached = self._cached(board, self.elo_rating)
+            if cached is not None:
+                self._best_moves, self._probabilities = cached
+                return
+            self._best_moves, self._probabilities = [], None
+            request_id = self._latest_id = next(self._ids)
+            self._sent[request_id] = (
+                board.copy(),
+                self.elo_rating,
+                time.perf_counter(),
+            )
+        message = {
+            "id": request_id,
+            "fen": board.fen(),
+            "elo": self.elo_rating,
+            "num_moves": self.num_moves,
+        }
+        try:
+            self._socket.sendall((json.dumps(message) + "\n").encode())
+        except OSError as e:
+            logger.warning("Could not reach the analysis server: %r", e)
+
+    def latest(self):
+        with self._lock:
+            return self._best_moves, self._probabilities
+
+    def done(self):
+        with self._lock:
+            return self._latest_id is None and self._probabilities is not None
+
+    @contextlib.contextmanager
+    def paused(self):
+        # The server owns the engines; only forget the current request
+        with self._lock:
+            self._requested_key = None
+            self._latest_id = None
+            self._best_moves, self._probabilities = [], None
+        yield
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self._socket.shutdown(socket.SHUT_RDWR)
+        self._thread.join(timeout=2)
+        self._reader.close()
+        self._socket.close()
+        self.analysis_cache.close()
+
+    def _cached(self, board, elo_rating):
+        # Caller holds self._lock
+        probabilities = self.evaluation_cache.get((position_key(board), elo_rating))
+        lines = self.analysis_cache.get(self._analysis_key(board, elo_rating))
+        if probabilities is None or lines is None:
+            return None
+        return best_moves_from_lines(lines), probabilities
+
+    def _analysis_key(self, board, elo_rating):
+        return analysis_key(board, "server", elo_rating, self.num_moves, None)
+
+    def _run(self):
+        with contextlib.suppress(OSError, ValueError):
+            for line in self._reader:
+                self._receive(json.loads(line))
+        logger.info("Analysis server connection closed")
+
+    def _receive(self, message):
+        with self._lock:
+            sent = self._sent.pop(message.get("id"), None)
+            if "error" in message:
+                logger.warning("Analysis server: %s", message["error"])
+            if sent is None or "best_moves" not in message:
+                return
+            board, elo_rating, started = sent
+            best_moves = [
+                (chess.Move.from_uci(uci), score)
+                for uci, score in message["best_moves"]
+            ]
+            probabilities = tuple(message["probabilities"])
+            self.analysis_cache.put(
+                self._analysis_key(board, elo_rating),
+                [([move], score) for move, score in best_moves],
+            )
+            self.evaluation_cache.put((position_key(board), elo_rating), probabilities)
+            self.search_stats["maia"] = {
+                "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+                "nodes": None,
+                "nps": None,
+            }
+            if message["id"] == self._latest_id:
+                self._latest_id = None
+                self._best_moves, self._probabilities = best_moves, probabilities
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve Maia analysis to several GUIs from shared engines."
+    )
+    parser.add_argument(
+        "--listen",
+        default=DEFAULT_ADDRESS,
+        help=f"host:port or Unix socket path (default: {DEFAULT_ADDRESS})",
+    )
+    parser.add_argument(
+        "--max-engines", type=int, default=3, help="Maia levels kept running"
+    )
+    parser.add_argument("--threads", type=int, default=2, help="threads per engine")
+    parser.add_argument(
+        "--workers", type=int, default=2, help="searches running at the same time"
+    )
+    parser.add_argument("--lc0", help="lc0 command (default: $MAIA_CHESS_LC0 or lc0)")
+    parser.add_argument(
+        "--weights", help="Maia weights path, {elo_rating} is replaced by the level"
+    )
+    parser.add_argument("--stockfish", default=STOCKFISH_COMMAND)
+    parser.add_argument(
+        "--analysis-cache", help="SQLite file for Maia lines (default: memory only)"
+    )
+    parser.add_argument("--tablebases", help="Syzygy tablebase directory")
+    parser.add_argument("--timing-log", help="write one JSON line per search here")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(message)s")
+    logger.setLevel(logging.INFO)
+    if args.timing_log:
+        from perf import enable_timing_log
+
+        enable_timing_log(args.timing_log)
+    engine_pool = MaiaEnginePool(
+        max_engines=args.max_engines,
+        threads=args.threads,
+        lc0=args.lc0,
+        weights=args.weights,
+    )
+    stockfish_engine = start_stockfish(args.stockfish)
+    analysis_cache = AnalysisCache(4096, args.analysis_cache)
+    known_positions = KnownPositions(None, args.tablebases)
+    server = AnalysisServer(
+        engine_pool,
+        stockfish_engine,
+        analysis_cache,
+        workers=args.workers,
+        known_positions=known_positions,
+    )
+    try:
+        asyncio.run(server.serve(args.listen))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        known_positions.close()
+        analysis_cache.close()
+        quit_engine(stockfish_engine)
+        engine_pool.close()
+
+
+if __name__ == "__main__":
+    main()
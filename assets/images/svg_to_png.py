@@ -1,6 +1,10 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
-import tkinter as tk
-from tkinter import filedialog, simpledialog
+import sys
+import time
 import cairosvg
 
 
@@ -31,7 +35,88 @@ def convert_svg_to_png(svg_files, size, input_directory, output_directory):
         )
 
 
-def main():
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def render_one(svg_file, size, output_file_path):
+    # Runs in a worker process; returns the time spent rendering
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    cairosvg.svg2png(
+        url=svg_file,
+        write_to=output_file_path,
+        output_width=size,
+        output_height=size,
+    )
+    return time.perf_counter() - start
+
+
+def build(input_directory, output_directory, sizes, workers=None, force=False):
+    """Render every SVG at every size into output_directory/<size>/.
+
+    A manifest in output_directory records the SVG hash each PNG was made
+    from, so files whose SVG and size are unchanged are skipped. Returns the
+    number of files that failed to render.
+    """
+    manifest_path = os.path.join(output_directory, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    jobs = []
+    skipped = 0
+    for svg_file in find_svg_files(input_directory):
+        svg_hash = file_hash(svg_file)
+        relative_path = os.path.splitext(os.path.relpath(svg_file, input_directory))[0]
+        for size in sizes:
+            output_relative = os.path.join(str(size), relative_path + ".png")
+            output_file_path = os.path.join(output_directory, output_relative)
+            entry = {"svg": svg_hash, "size": size}
+            if manifest.get(output_relative) == entry and os.path.exists(
+                output_file_path
+            ):
+                skipped += 1
+                continue
+            jobs.append((svg_file, size, output_file_path, output_relative, entry))
+
+    rendered = failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for job in jobs:
+            svg_file, size, output_file_path, _, _ = job
+            future = executor.submit(render_one, svg_file, size, output_file_path)
+            futures[future] = job
+        for future in concurrent.futures.as_completed(futures):
+            svg_file, size, _, output_relative, entry = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                print(f"FAILED {output_relative}: {e}", file=sys.stderr)
+                manifest.pop(output_relative, None)
+                failed += 1
+                continue
+            manifest[output_relative] = entry
+            rendered += 1
+            print(f"{seconds * 1000:8.1f} ms  {output_relative}")
+
+    os.makedirs(output_directory, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(
+        f"Rendered {rendered} files, skipped {skipped} unchanged, "
+        f"{failed} failed, in {time.perf_counter() - start:.2f} s"
+    )
+    return failed
+
+
+def interactive_main():
+    import tkinter as tk
+    from tkinter import filedialog, simpledialog
+
     root = tk.Tk()
     root.withdraw()  # Hide the root window
 
@@ -64,5 +149,37 @@ def main():
     print("Conversion complete. PNG files are saved in:", output_directory)
 
 
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        # No arguments: ask for the input directory and size with dialogs
+        interactive_main()
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Render SVG piece sets to PNG at one or more sizes."
+    )
+    parser.add_argument("input", help="directory to search for .svg files")
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=int,
+        nargs="+",
+        required=True,
+        help="output sizes in pixels, each written to OUTPUT/<size>/",
+    )
+    parser.add_argument("-o", "--output", default="pngs", help="output directory")
+    parser.add_argument(
+        "-j", "--workers", type=int, help="worker processes (default: all cores)"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="ignore the manifest and render all"
+    )
+    args = parser.parse_args(argv)
+    failed = build(args.input, args.output, args.sizes, args.workers, args.force)
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""Annotate PGN collections with Maia suggestions and Stockfish probabilities.
+
+The same numbers the GUI shows, computed offline for whole game collections
+without opening a window. Games are spread over a pool of worker processes,
+each of which owns its own lc0 and Stockfish.
+
+    python batch_analysis.py games.pgn more_games.pgn -o annotated.jsonl
+    python batch_analysis.py games.pgn -o annotated.pgn --format pgn --workers 8
+
+--policy-only skips the searches and Stockfish and records Maia's move
+probabilities from its policy instead, a few milliseconds per position.
+Each worker then runs --policy-engines lc0 processes and spreads the
+positions of a game over them, so their one-node searches overlap:
+
+    python batch_analysis.py games.pgn -o policy.jsonl --policy-only
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import multiprocessing.util
+import os
+import sys
+import time
+import chess
+import chess.engine
+import chess.pgn
+from analysis import analyse_position, evaluate_position, get_policies
+from engines import (
+    MAIA_ELOS,
+    STOCKFISH_COMMAND,
+    enable_wdl,
+    engine_command,
+    maia_command,
+)
+
+# Engines owned by the current worker process
+_engines = {}
+
+
+def start_engines(
+    elo_rating, maia_cmd, stockfish_cmd, maia_time, stockfish_time, maia_engines=1
+):
+    maias = []
+    for _ in range(maia_engines):
+        maia = chess.engine.SimpleEngine.popen_uci(maia_cmd)
+        maia.configure({"Threads": 1})
+        enable_wdl(maia)
+        maias.append(maia)
+    stockfish = None
+    if stockfish_cmd is not None:
+        stockfish = chess.engine.SimpleEngine.popen_uci(stockfish_cmd)
+        stockfish.configure({"Threads": 1})
+        enable_wdl(stockfish)
+    _engines.update(
+        maia=maias[0],
+        maias=maias,
+        stockfish=stockfish,
+        elo_rating=elo_rating,
+        maia_limit=chess.engine.Limit(time=maia_time),
+        stockfish_limit=chess.engine.Limit(time=stockfish_time),
+    )
+    # Pool workers skip atexit handlers, but run multiprocessing finalizers
+    multiprocessing.util.Finalize(None, stop_engines, exitpriority=10)
+
+
+def stop_engines():
+    _engines.pop("maia", None)
+    for engine in _engines.pop("maias", []) + [_engines.pop("stockfish", None)]:
+        if engine is not None:
+            engine.quit()
+
+
+def annotate_game(pgn_text, num_moves):
+    """Analyse every position of one game in this worker process.
+
+    Returns the annotated PGN text and one record per analysed position.
+    """
+    game = chess.pgn.read_game(io.StringIO(pgn_text))
+    records = []
+    node = game
+    while True:
+        board = node.board()
+        if board.is_game_over():
+            break
+        best_moves, probabilities = analyse_position(
+            _engines["maia"], board, num_moves, _engines["maia_limit"]
+        )
+        if probabilities is None:
+            # No WDL from Maia, ask Stockfish
+            probabilities = evaluate_position(
+                _engines["stockfish"], board, _engines["stockfish_limit"]
+            )
+        win_prob, draw_prob, loss_prob = probabilities
+        next_node = node.next()
+        records.append(
+            {
+                "ply": board.ply(),
+                "fen": board.fen(),
+                "played": next_node.move.uci() if next_node else None,
+                "maia_elo": _engines["elo_rating"],
+                "maia": [
+                    {"move": move.uci(), "score": score} for move, score in best_moves
+                ],
+                "win": win_prob,
+                "draw": draw_prob,
+                "loss": loss_prob,
+            }
+        )
+        suggestions = ", ".join(
+            f"{board.san(move)} ({score:.2f})" for move, score in best_moves
+        )
+        comment = (
+            f"Maia {_engines['elo_rating']}: {suggestions}; "
+            f"W {win_prob:.1%} D {draw_prob:.1%} L {loss_prob:.1%}"
+        )
+        node.comment = f"{node.comment} {comment}".strip()
+        if next_node is None:
+            break
+        node = next_node
+    return str(game), records
+
+
+def policy_game(pgn_text, num_moves):
+    """Like annotate_game(), with Maia's policy for every position instead.
+
+    The positions are shared out between this worker's lc0 processes, which
+    run their one-node searches at the same time.
+    """
+    game = chess.pgn.read_game(io.StringIO(pgn_text))
+    nodes = []
+    node = game
+    while node is not None and not node.board().is_game_over():
+        nodes.append(node)
+        node = node.next()
+    boards = [node.board() for node in nodes]
+    policies = get_policies(_engines["maias"], boards)
+    records = []
+    for node, board, policy in zip(nodes, boards, policies):
+        next_node = node.next()
+        played = dict(policy).get(next_node.move) if next_node else None
+        records.append(
+            {
+                "ply": board.ply(),
+                "fen": board.fen(),
+                "played": next_node.move.uci() if next_node else None,
+                "maia_elo": _engines["elo_rating"],
+                "policy": [
+                    {"move": move.uci(), "probability": probability}
+                    for move, probability in policy[:num_moves]
+                ],
+                "played_probability": played,
+            }
+        )
+        suggestions = ", ".join(
+            f"{board.san(move)} {probability:.1%}"
+            for move, probability in policy[:num_moves]
+        )
+        comment = f"Maia {_engines['elo_rating']} policy: {suggestions}"
+        if played is not None:
+            comment += f"; played {played:.1%}"
+        node.comment = f"{node.comment} {comment}".strip()
+    return str(game), records
+
+
+def read_games(paths):
+    # Yields PGN text so games can be sent to worker processes cheaply
+    for path in paths:
+        with open(path, encoding="utf-8-sig") as pgn:
+            while True:
+                game = chess.pgn.read_game(pgn)
+                if game is None:
+                    break
+                yield str(game)
+
+
+def write_result(output, output_format, game_index, annotated_pgn, records):
+    if output_format == "pgn":
+        output.write(annotated_pgn + "\n\n")
+    else:
+        for record in records:
+            output.write(json.dumps({"game": game_index, **record}) + "\n")
+    output.flush()
+
+
+def run(args):
+    workers = args.workers or os.cpu_count() or 1
+    maia_cmd = maia_command(args.elo, args.lc0, args.weights)
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=start_engines,
+        initargs=(
+            args.elo,
+            maia_cmd,
+            None if args.policy_only else engine_command(args.stockfish),
+            args.maia_time,
+            args.stockfish_time,
+            args.policy_engines if args.policy_only else 1,
+        ),
+    )
+    games = enumerate(read_games(args.pgn))
+    pending = {}
+    next_to_write = 0
+    finished = {}
+    positions = 0
+    start = time.perf_counter()
+
+    def report():
+        elapsed = time.perf_counter() - start
+        rate = positions / elapsed if elapsed else 0.0
+        print(
+            f"{next_to_write} games, {positions} positions, "
+            f"{rate:.1f} positions/s, {rate / workers:.2f} positions/s per core",
+            file=sys.stderr,
+        )
+
+    with executor, open(args.output, "w", encoding="utf-8") as output:
+        while True:
+            # Keep a bounded number of games in flight so input is streamed
+            while len(pending) < 2 * workers:
+                try:
+                    game_index, pgn_text = next(games)
+                except StopIteration:
+                    break
+                future = executor.submit(
+                    policy_game if args.policy_only else annotate_game,
+                    pgn_text,
+                    args.num_moves,
+                )
+                pending[future] = game_index
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                finished[pending.pop(future)] = future.result()
+            # Write in input order as soon as the next game is ready
+            while next_to_write in finished:
+                annotated_pgn, records = finished.pop(next_to_write)
+                write_result(output, args.format, next_to_write, annotated_pgn, records)
+                positions += len(records)
+                next_to_write += 1
+                if next_to_write % args.report_every == 0:
+                    report()
+    report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Annotate PGN files with Maia suggestions and Stockfish win/draw/loss probabilities."
+    )
+    parser.add_argument("pgn", nargs="+", help="PGN files to analyse")
+    parser.add_argument("-o", "--output", required=True, help="output file")
+    parser.add_argument(
+        "--format",
+        choices=("jsonl", "pgn"),
+        default="jsonl",
+        help="one JSON record per position, or the games with comments added",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="worker processes, each running its own lc0 and Stockfish (default: all cores)",
+    )
+    parser.add_argument("--elo", type=int, default=1500, help="Maia level")
+    parser.add_argument("--num-moves", type=int, default=3, help="Maia moves to list")
+    parser.add_argument(
+        "--policy-only",
+        action="store_true",
+        help="record Maia's move probabilities without searching",
+    )
+    parser.add_argument(
+        "--policy-engines",
+        type=int,
+        default=2,
+        help="lc0 processes per worker with --policy-only, searching in parallel",
+    )
+    parser.add_argument("--maia-time", type=float, default=1.0)
+    parser.add_argument("--stockfish-time", type=float, default=0.1)
+    parser.add_argument("--lc0", help="lc0 command (default: $MAIA_CHESS_LC0 or lc0)")
+    parser.add_argument(
+        "--weights",
+        help="Maia weights path, {elo_rating} is replaced by the level",
+    )
+    parser.add_argument("--stockfish", default=STOCKFISH_COMMAND)
+    parser.add_argument(
+        "--report-every",
+        type=int,
+        default=10,
+        help="print throughput after every N games",
+    )
+    args = parser.parse_args(argv)
+    if args.elo not in MAIA_ELOS:
+        parser.error("--elo must be between 1100 and 1900 in increments of 100")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
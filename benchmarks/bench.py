@@ -0,0 +1,347 @@
+"""Benchmarks for the GUI's drawing hot paths and the engine round trip.
+
+Runs headless with SDL's dummy video driver and uses fake_engine.py in place
+of lc0 and Stockfish, so the numbers only depend on this code and the
+machine. Reports per-function timings, frames per second for replayed input
+scripts, engine round-trip latency and peak memory.
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench.py --baseline benchmarks/baseline.json
+
+With --baseline, every timing is compared against the saved run and the exit
+status is 1 if any got slower by more than --tolerance.
+"""
+
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+# pygame's import banner would end up in the JSON on stdout
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import argparse
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+import chess
+import chess.engine
+import pygame
+import maia_chess
+from analysis import AnalysisWorker, evaluate_position, get_best_moves, get_policy
+from cache import AnalysisCache
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+POSITIONS = {
+    "start": chess.STARTING_FEN,
+    "italian": "r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+    "middlegame": "r2q1rk1/pp2bppp/2n1bn2/3p4/3P4/2NBBN2/PP3PPP/R2Q1RK1 w - - 6 11",
+    "endgame": "8/5pk1/6p1/8/3R4/6P1/5PKP/3r4 w - - 0 40",
+    "promotion": "8/4P1k1/8/8/8/8/6K1/8 w - - 0 1",
+}
+
+# Replayed as clicks: select the from square, click the to square, then a few
+# idle frames while the "engine" thinks. Afterwards every move is undone.
+SCRIPT = ["e2e4", "e7e5", "g1f3", "b8c6", "f1c4", "g8f6", "d2d3", "f8c5", "e1g1"]
+IDLE_FRAMES = 5
+
+FAKE_ENGINE = [sys.executable, os.path.join(ROOT, "fake_engine.py")]
+
+
+def summary(times):
+    ordered = sorted(times)
+    return {
+        "calls": len(ordered),
+        "mean_us": round(statistics.fmean(ordered) * 1e6, 1),
+        "p50_us": round(ordered[len(ordered) // 2] * 1e6, 1),
+        "p95_us": round(
+            ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1e6, 1
+        ),
+    }
+
+
+def measure(times, func, *args, iterations=100):
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+
+def fake_best_moves(board, count=3):
+    moves = sorted(board.legal_moves, key=chess.Move.uci)[:count]
+    return [(move, 0.5 - 0.1 * i) for i, move in enumerate(moves)]
+
+
+def bench_functions(window, iterations):
+    times = {}
+    for fen in POSITIONS.values():
+        board = chess.Board(fen)
+        move_index = maia_chess.build_move_index(board)
+        best_moves = fake_best_moves(board)
+        # The piece with the most legal moves, the worst case for highlighting
+        selected = max(move_index, key=lambda square: len(move_index[square]))
+        move = best_moves[0][0]
+        cases = {
+            "draw_board": (maia_chess.draw_board, window),
+            "draw_pieces": (maia_chess.draw_pieces, board),
+            "highlight_legal_moves": (
+                maia_chess.highlight_legal_moves,
+                window,
+                move_index,
+                selected,
+            ),
+            "draw_move_arrow": (
+                maia_chess.draw_move_arrow,
+                window,
+                move.from_square,
+                move.to_square,
+            ),
+            "draw_arrows": (maia_chess.draw_arrows, window, best_moves),
+            "display_best_moves_text": (
+                maia_chess.display_best_moves_text,
+                best_moves,
+            ),
+            "build_move_index": (maia_chess.build_move_index, board),
+        }
+        for name, (func, *args) in cases.items():
+            measure(times.setdefault(name, []), func, *args, iterations=iterations)
+    return {name: summary(values) for name, values in times.items()}
+
+
+def bench_frames(window, repeats):
+    renderer = maia_chess.Renderer(window)
+    input_box = maia_chess.INPUT_BOX.copy()
+    color = pygame.Color("lightskyblue3")
+    results = {}
+
+    def frame(times, board, selected=None, last_move=None):
+        move_index = maia_chess.build_move_index(board)
+        start = time.perf_counter()
+        renderer.render(
+            board,
+            move_index,
+            selected,
+            last_move,
+            fake_best_moves(board),
+            (0.53, 0.0, 0.47),
+            input_box,
+            "",
+            color,
+        )
+        times.append(time.perf_counter() - start)
+
+    # Every frame repainted from scratch, the cost before dirty rects
+    times = []
+    for _ in range(repeats):
+        for fen in POSITIONS.values():
+            renderer.invalidate()
+            frame(times, chess.Board(fen))
+    results["full_redraw"] = times
+
+    # Select, move and idle through SCRIPT, then undo it all
+    times = []
+    for _ in range(repeats):
+        board = chess.Board()
+        renderer.invalidate()
+        for uci in SCRIPT:
+            move = chess.Move.from_uci(uci)
+            frame(times, board, move.from_square)
+            board.push(move)
+            for _ in range(IDLE_FRAMES):
+                frame(times, board, last_move=move)
+        while board.move_stack:
+            board.pop()
+            last_move = board.peek() if board.move_stack else None
+            for _ in range(IDLE_FRAMES):
+                frame(times, board, last_move=last_move)
+    results["move_script"] = times
+
+    return {
+        name: {"fps": round(len(times) / sum(times), 1), **summary(times)}
+        for name, times in results.items()
+    }
+
+
+def bench_engine(latency, repeats):
+    command = FAKE_ENGINE + ["--latency", str(latency)]
+    maia = chess.engine.SimpleEngine.popen_uci(command)
+    stockfish = chess.engine.SimpleEngine.popen_uci(command)
+    results = {}
+    try:
+        direct = {"get_best_moves": [], "evaluate_position": [], "get_policy": []}
+        for _ in range(repeats):
+            for fen in POSITIONS.values():
+                board = chess.Board(fen)
+                measure(
+                    direct["get_best_moves"], get_best_moves, maia, board, iterations=1
+                )
+                measure(direct["get_policy"], get_policy, maia, board, iterations=1)
+                measure(
+                    direct["evaluate_position"],
+                    evaluate_position,
+                    stockfish,
+                    board,
+                    iterations=1,
+                )
+        for name, times in direct.items():
+            results[name] = summary(times)
+
+        # Through the worker the GUI uses; pondering is off so every search
+        # is for a requested position
+        worker = AnalysisWorker(
+            maia, stockfish, analysis_cache=AnalysisCache(4096), ponder_moves=0
+        )
+        try:
+            first_lines, complete, cached = [], [], []
+            for fen in POSITIONS.values():
+                first, done = request_and_wait(worker, chess.Board(fen))
+                first_lines.append(first)
+                complete.append(done)
+            for fen in POSITIONS.values():
+                cached.append(request_and_wait(worker, chess.Board(fen), False)[1])
+            results["worker_first_lines"] = summary(first_lines)
+            results["worker_complete"] = summary(complete)
+            results["worker_cached"] = summary(cached)
+        finally:
+            worker.close()
+    finally:
+        maia.quit()
+        stockfish.quit()
+    return results
+
+
+def request_and_wait(worker, board, searched=True, timeout=10):
+    # Returns the seconds until the first Maia lines and until all results are
+    # in. A search records its search_stats once it has finished and cached
+    # its result; positions answered from the caches record nothing.
+    worker.search_stats.clear()
+    start = time.perf_counter()
+    worker.request(board)
+    first = None
+    while time.perf_counter() - start < timeout:
+        best_moves, probabilities = worker.latest()
+        if best_moves and first is None:
+            first = time.perf_counter() - start
+        finished = not searched or len(worker.search_stats) == 2
+        if best_moves and probabilities is not None and finished:
+            return first, time.perf_counter() - start
+        time.sleep(0.0005)
+    raise TimeoutError("Analysis did not finish")
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """Print how results differ from baseline and return the regressions.
+
+    The table goes to stderr, as stdout is kept for the JSON results.
+    """
+    current = flatten(results)
+    regressions = []
+    for key, old in flatten(baseline).items():
+        new = current.get(key)
+        is_timing = key.endswith(("mean_us", "p95_us"))
+        if not (is_timing or key.endswith("fps")) or not old or new is None:
+            continue
+        # Timings should go down, frame rates up
+        ratio = new / old if is_timing else old / new
+        mark = ""
+        if ratio > 1 + tolerance:
+            mark = "  SLOWER"
+            regressions.append(key)
+        elif ratio < 1 - tolerance:
+            mark = "  faster"
+        print(f"{key:45} {old:>12} {new:>12} {ratio:6.2f}x{mark}", file=sys.stderr)
+    return regressions
+
+
+def run(args):
+    os.chdir(ROOT)  # Assets are found relative to the working directory
+    tracemalloc.start()
+    started = time.perf_counter()
+    window = maia_chess.init_display()
+    maia_chess.load_images()
+    results = {
+        "machine": {
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+        },
+        "functions": bench_functions(window, args.iterations),
+        "frames": bench_frames(window, args.repeats),
+    }
+    if not args.skip_engine:
+        results["engine"] = bench_engine(args.latency, args.repeats)
+    memory = {"tracemalloc_peak_kb": tracemalloc.get_traced_memory()[1] // 1024}
+    if resource is not None:
+        memory["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["memory"] = memory
+    results["seconds"] = round(time.perf_counter() - started, 2)
+    pygame.quit()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark rendering and engine round trips headlessly."
+    )
+    parser.add_argument("-o", "--output", help="write the results as JSON here")
+    parser.add_argument("--baseline", help="compare against a saved results file")
+    parser.add_argument("--save-baseline", help="write the results as a new baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed slowdown against the baseline (default: 0.1 = 10%%)",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=100, help="calls per function per position"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=5, help="replays of each frame and engine script"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds the fake engine takes per search",
+    )
+    parser.add_argument("--skip-engine", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    print(text)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} timings regressed", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
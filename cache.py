@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+import chess
+import chess.polyglot
+
+
+def position_key(board):
+    """Zobrist hash of board, the key every position cache is indexed by."""
+    return chess.polyglot.zobrist_hash(board)
+
+
+class LRUCache:
+    """Dict-like cache that evicts the least recently used entry when full."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def analysis_key(board, engine_id, elo_rating, multipv, limit):
+    return (position_key(board), engine_id, elo_rating, multipv, repr(limit))
+
+
+class AnalysisCache:
+    """Multi-PV search results keyed by analysis_key().
+
+    Lookups go to an in-memory LRU first. When path is given, every result is
+    also written to an SQLite database there, so positions analysed in an
+    earlier session come back without a search.
+    """
+
+    def __init__(self, maxsize=4096, path=None):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analysis (key TEXT PRIMARY KEY, lines TEXT)"
+            )
+            self._db.commit()
+
+    def __contains__(self, key):
+        # Membership test that leaves the LRU order and hit counters alone
+        with self._lock:
+            if key in self.memory:
+                return True
+            if self._db is None:
+                return False
+            row = self._db.execute(
+                "SELECT 1 FROM analysis WHERE key = ?", (_db_key(key),)
+            ).fetchone()
+            return row is not None
+
+    def get(self, key):
+        """Return the cached [(pv, score), ...] lines for key, or None."""
+        with self._lock:
+            lines = self.memory.get(key)
+            if lines is not None or self._db is None:
+                return lines
+            row = self._db.execute(
+                "SELECT lines FROM analysis WHERE key = ?", (_db_key(key),)
+            ).fetchone()
+            if row is None:
+                return None
+            lines = [
+                ([chess.Move.from_uci(uci) for uci in pv], score)
+                for pv, score in json.loads(row[0])
+            ]
+            self.memory.put(key, lines)
+            return lines
+
+    def put(self, key, lines):
+        with self._lock:
+            self.memory.put(key, lines)
+            if self._db is None:
+                return
+            encoded = json.dumps(
+                [([move.uci() for move in pv], score) for pv, score in lines]
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO analysis (key, lines) VALUES (?, ?)",
+                (_db_key(key), encoded),
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def _db_key(key):
+    return ":".join(str(part) for part in key)
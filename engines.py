@@ -0,0 +1,180 @@
+from collections import Counter, OrderedDict
+import asyncio
+import contextlib
+import logging
+import os
+import shlex
+import threading
+import chess.engine
+
+logger = logging.getLogger(__name__)
+
+MAIA_ELOS = range(1100, 2000, 100)
+
+# Engine commands can be overridden with these environment variables (or the
+# matching command line options). Commands are split like a shell would, so
+# "python fake_engine.py --latency 0.01" works as well as a path.
+LC0_COMMAND = os.environ.get("MAIA_CHESS_LC0", "lc0")
+MAIA_WEIGHTS = os.environ.get(
+    "MAIA_CHESS_WEIGHTS", "assets/models/maia-{elo_rating}.pb.gz"
+)
+STOCKFISH_COMMAND = os.environ.get(
+    "MAIA_CHESS_STOCKFISH", "/opt/homebrew/bin/stockfish"
+)
+
+
+def maia_command(elo_rating, lc0=None, weights=None):
+    weights = (weights or MAIA_WEIGHTS).format(elo_rating=elo_rating)
+    return shlex.split(lc0 or LC0_COMMAND) + [f"--weights={weights}"]
+
+
+def engine_command(command):
+    return shlex.split(command)
+
+
+def enable_wdl(engine):
+    # Win/draw/loss statistics in every info line, if the engine has them
+    if "UCI_ShowWDL" in engine.options:
+        engine.configure({"UCI_ShowWDL": True})
+
+
+def start_stockfish(command=STOCKFISH_COMMAND):
+    engine = chess.engine.SimpleEngine.popen_uci(engine_command(command))
+    enable_wdl(engine)
+    return engine
+
+
+def quit_engine(engine):
+    try:
+        engine.quit()
+    except chess.engine.EngineError:
+        pass  # Already gone
+    except asyncio.TimeoutError:
+        engine.close()  # Stopped answering, kill it
+
+
+class MaiaEnginePool:
+    """Keeps lc0 processes for several Maia levels running between Elo changes.
+
+    At most max_engines processes are alive at once; when the budget is
+    exceeded the least recently used level is shut down. The level handed out
+    last by get() is pinned and never evicted, since the GUI is using it.
+    lc0 and weights override LC0_COMMAND and MAIA_WEIGHTS.
+    """
+
+    def __init__(self, max_engines=3, threads=2, lc0=None, weights=None):
+        self.max_engines = max_engines
+        self.threads = threads
+        self.lc0 = lc0
+        self.weights = weights
+        self.active = None
+        self._engines = OrderedDict()
+        self._starting = {}
+        self._leases = Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._engines)
+
+    def get(self, elo_rating):
+        """Return a running engine for elo_rating, starting it if needed."""
+        while True:
+            engine = self._checkout(elo_rating)
+            with self._lock:
+                # A prewarm may have evicted it again before it was pinned
+                if self._engines.get(elo_rating) is engine:
+                    self.active = elo_rating
+                    self._engines.move_to_end(elo_rating)
+                    evicted = self._evict()
+                    break
+        for old_engine in evicted:
+            quit_engine(old_engine)
+        return engine
+
+    @contextlib.contextmanager
+    def lease(self, elo_rating):
+        """Use the engine for elo_rating without pinning it as the active one.
+
+        For several users of one pool, e.g. the analysis server: levels that
+        are leased are never evicted, whatever max_engines says. Only one
+        search may run on an engine at a time.
+        """
+        with self._lock:
+            self._leases[elo_rating] += 1
+        try:
+            yield self._checkout(elo_rating)
+        finally:
+            with self._lock:
+                self._leases[elo_rating] -= 1
+                if not self._leases[elo_rating]:
+                    del self._leases[elo_rating]
+                evicted = self._evict()
+            for old_engine in evicted:
+                quit_engine(old_engine)
+
+    def prewarm(self, elo_ratings):
+        """Start engines for elo_ratings in the background."""
+
+        def run():
+            for elo_rating in elo_ratings:
+                try:
+                    self._checkout(elo_rating)
+                except (chess.engine.EngineError, OSError) as e:
+                    logger.warning("Could not start Maia %s: %s", elo_rating, e)
+
+        threading.Thread(target=run, name="engine-prewarm", daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+        for engine in engines:
+            quit_engine(engine)
+
+    def _checkout(self, elo_rating):
+        with self._lock:
+            if elo_rating in self._engines:
+                return self._engines[elo_rating]
+            # Another thread may already be starting this level
+            starting = self._starting.get(elo_rating)
+            if starting is None:
+                starting = self._starting[elo_rating] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            starting.wait()
+            return self._checkout(elo_rating)
+
+        try:
+            engine = chess.engine.SimpleEngine.popen_uci(
+                maia_command(elo_rating, self.lc0, self.weights)
+            )
+            engine.configure({"Threads": self.threads})
+            enable_wdl(engine)
+        except BaseException:
+            with self._lock:
+                del self._starting[elo_rating]
+            starting.set()
+            raise
+
+        with self._lock:
+            self._engines[elo_rating] = engine
+            evicted = self._evict(keep=elo_rating)
+            del self._starting[elo_rating]
+        starting.set()
+        for old_engine in evicted:
+            quit_engine(old_engine)
+        return engine
+
+    def _evict(self, keep=None):
+        # Caller holds self._lock
+        evicted = []
+        for elo_rating in list(self._engines):
+            if len(self._engines) <= self.max_engines:
+                break
+            if elo_rating not in (self.active, keep) and not self._leases[elo_rating]:
+                evicted.append(self._engines.pop(elo_rating))
+        return evicted
@@ -0,0 +1,238 @@
+"""A stand-in UCI engine with deterministic output and latency.
+
+Answers like lc0 or Stockfish closely enough for the GUI, batch analysis and
+the benchmarks, without the real binaries or network weights. Lines are the
+legal moves in UCI order, scored 50, 40, 30, ... centipawns, reported once
+per depth with an even share of the search time between depths.
+
+Win/draw/loss statistics are sent once UCI_ShowWDL is enabled; --no-wdl
+behaves like an engine without them. With VerboseMoveStats every search ends
+with lc0-style per-move lines giving each legal move a prior, highest first
+in UCI order.
+
+Failure modes for load and robustness tests: --crash-after exits in the middle
+of a search, --hang-after stops answering altogether, --bad-info-every mixes
+malformed info lines into the output and --lines reports fewer lines than
+MultiPV asked for. --jitter adds seeded random latency, so runs repeat exactly.
+
+    python fake_engine.py --latency 0.05 --depth 4
+    python fake_engine.py --latency 0.01 --jitter 0.02 --seed 7 --crash-after 500
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import chess
+
+DEFAULT_LATENCY = 0.05  # Seconds per "go" with a time or depth limit
+DEFAULT_DEPTH = 4
+
+
+class FakeEngine:
+    def __init__(
+        self,
+        latency=DEFAULT_LATENCY,
+        depth=DEFAULT_DEPTH,
+        name="Fake",
+        wdl=True,
+        lines=0,
+        jitter=0.0,
+        seed=0,
+        crash_after=0,
+        hang_after=0,
+        bad_info_every=0,
+    ):
+        self.latency = latency
+        self.depth = depth
+        self.name = name
+        self.wdl = wdl
+        self.show_wdl = False
+        self.verbose_move_stats = False
+        self.lines = lines
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.crash_after = crash_after
+        self.hang_after = hang_after
+        self.bad_info_every = bad_info_every
+        self.searches = 0
+        self.hung = False
+        self.board = chess.Board()
+        self.multipv = 1
+        self._search = None
+        self._stop = threading.Event()
+        self._output_lock = threading.Lock()
+
+    def send(self, line):
+        with self._output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def run(self):
+        for line in sys.stdin:
+            parts = line.split()
+            if not parts or self.hung:
+                continue
+            command = parts[0]
+            if command == "uci":
+                self.send(f"id name {self.name}")
+                self.send("id author python_chess_gui")
+                self.send("option name MultiPV type spin default 1 min 1 max 500")
+                self.send("option name Threads type spin default 1 min 1 max 512")
+                if self.wdl:
+                    self.send("option name UCI_ShowWDL type check default false")
+                self.send("option name VerboseMoveStats type check default false")
+                self.send("uciok")
+            elif command == "isready":
+                self.wait_for_search()
+                self.send("readyok")
+            elif command == "setoption":
+                self.set_option(parts)
+            elif command == "ucinewgame":
+                self.board = chess.Board()
+            elif command == "position":
+                self.set_position(parts)
+            elif command == "go":
+                self.wait_for_search()
+                self.searches += 1
+                if self.hang_after and self.searches >= self.hang_after:
+                    self.hung = True  # Ignore everything from now on
+                    continue
+                self._stop.clear()
+                self._search = threading.Thread(
+                    target=self.search, args=(parts[1:],), daemon=True
+                )
+                self._search.start()
+            elif command == "stop":
+                self._stop.set()
+                self.wait_for_search()
+            elif command == "quit":
+                self._stop.set()
+                self.wait_for_search()
+                return
+
+    def wait_for_search(self):
+        if self._search is not None:
+            self._search.join()
+            self._search = None
+
+    def set_option(self, parts):
+        if "name" not in parts or "value" not in parts:
+            return
+        name = " ".join(parts[parts.index("name") + 1 : parts.index("value")])
+        value = " ".join(parts[parts.index("value") + 1 :])
+        if name.lower() == "multipv":
+            self.multipv = max(1, int(value))
+        elif name.lower() == "uci_showwdl":
+            self.show_wdl = self.wdl and value.lower() == "true"
+        elif name.lower() == "verbosemovestats":
+            self.verbose_move_stats = value.lower() == "true"
+
+    def set_position(self, parts):
+        if parts[1] == "startpos":
+            self.board = chess.Board()
+        else:
+            end = parts.index("moves") if "moves" in parts else len(parts)
+            self.board = chess.Board(" ".join(parts[2:end]))
+        if "moves" in parts:
+            for uci in parts[parts.index("moves") + 1 :]:
+                self.board.push_uci(uci)
+
+    def search(self, args):
+        infinite = "infinite" in args
+        depth = self.depth
+        if "depth" in args:
+            depth = min(depth, int(args[args.index("depth") + 1]))
+        count = min(self.multipv, self.lines) if self.lines else self.multipv
+        moves = sorted(self.board.legal_moves, key=chess.Move.uci)[:count]
+        # Each depth takes an even share of the full search's latency, so
+        # depth-limited searches finish early
+        latency = self.latency + self.random.uniform(0, self.jitter)
+        step = latency / self.depth
+        if "nodes" in args:
+            depth = 1  # lc0's policy lookups: a single evaluation
+        start = time.perf_counter()
+        for current_depth in range(1, depth + 1):
+            if self._stop.wait(step):
+                break
+            if self.crash_after and self.searches >= self.crash_after:
+                os._exit(1)  # Die mid-search without a bestmove
+            if self.bad_info_every and self.searches % self.bad_info_every == 0:
+                self.send("info depth x multipv score cp pv z9z9")
+            elapsed = time.perf_counter() - start
+            nodes = 1000 * current_depth
+            for i, move in enumerate(moves):
+                score = 50 - 10 * i
+                wdl = f"wdl {350 + score} 450 {200 - score} " if self.show_wdl else ""
+                self.send(
+                    f"info depth {current_depth} multipv {i + 1} "
+                    f"score cp {score} {wdl}nodes {nodes} "
+                    f"nps {int(nodes / elapsed)} time {int(elapsed * 1000)} "
+                    f"pv {move.uci()}"
+                )
+        if infinite:
+            self._stop.wait()
+        if self.verbose_move_stats:
+            self.send_move_stats()
+        self.send(f"bestmove {moves[0].uci() if moves else '0000'}")
+
+    def send_move_stats(self):
+        # Priors proportional to 1, 1/2, 1/3, ... over the legal moves
+        moves = sorted(self.board.legal_moves, key=chess.Move.uci)
+        total = sum(1 / (i + 1) for i in range(len(moves)))
+        for i, move in reversed(list(enumerate(moves))):
+            prior = 100 / (i + 1) / total
+            self.send(
+                f"info string {move.uci():5} ({i:>3} ) N: 0 (+ 0) "
+                f"(P: {prior:5.2f}%) (Q: 0.00000) (V:  -.----)"
+            )
+        self.send("info string node  ( 20) N: 1 (+ 0) (P: 100.00%) (V: 0.0000)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY)
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH)
+    parser.add_argument("--name", default="Fake")
+    parser.add_argument(
+        "--no-wdl", action="store_true", help="do not offer UCI_ShowWDL"
+    )
+    parser.add_argument(
+        "--lines", type=int, default=0, help="report at most this many lines"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="extra random latency, seconds"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--crash-after", type=int, default=0, help="exit during the Nth search"
+    )
+    parser.add_argument(
+        "--hang-after", type=int, default=0, help="stop answering at the Nth search"
+    )
+    parser.add_argument(
+        "--bad-info-every",
+        type=int,
+        default=0,
+        help="send a malformed info line in every Nth search",
+    )
+    # Unknown options such as lc0's --weights are ignored
+    args, _ = parser.parse_known_args(argv)
+    FakeEngine(
+        args.latency,
+        args.depth,
+        args.name,
+        not args.no_wdl,
+        args.lines,
+        args.jitter,
+        args.seed,
+        args.crash_after,
+        args.hang_after,
+        args.bad_info_every,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""The game played in the GUI as a tree of variations."""
+
+import chess
+import chess.pgn
+
+
+class GameTree:
+    """Moves played so far as a chess.pgn game, and where the user is in it.
+
+    Taking a move back keeps it: forward() plays it again, and playing a
+    different move adds a variation next to it, so no line is ever lost.
+    board is the current position. Every step is a single push or pop on it,
+    and switching variations a pop and a push, so navigation never replays
+    the game from the start.
+
+    Each node also remembers the analysis shown for it per Maia level, so
+    stepping through the game again needs no engine at all.
+
+    log, if set, is told about every step and remembered analysis, e.g. a
+    session_log.SessionRecorder. Forward and variation switches reach it as
+    plain back and play steps.
+    """
+
+    def __init__(self):
+        self.game = chess.pgn.Game()
+        self.node = self.game
+        self.board = chess.Board()
+        self._analysis = {}  # (node, elo_rating) -> (best_moves, probabilities)
+        self._last_child = {}  # node -> child forward() goes to
+        self.log = None
+
+    @property
+    def last_move(self):
+        return None if self.node is self.game else self.node.move
+
+    def play(self, move):
+        """Play move, following the existing variation for it if there is one."""
+        child = self.node.variation(move) if self.node.has_variation(move) else None
+        if child is None:
+            child = self.node.add_variation(move)
+        self._enter(child)
+
+    def back(self):
+        if self.node.parent is None:
+            return False
+        self._last_child[self.node.parent] = self.node
+        self._leave()
+        return True
+
+    def forward(self):
+        """Step into the variation visited last, or the main line."""
+        child = self._last_child.get(self.node)
+        if child is None:
+            child = self.node.next()
+        if child is None:
+            return False
+        self._enter(child)
+        return True
+
+    def switch_variation(self, step):
+        """Move to the step-th next (or previous, if negative) sibling line."""
+        parent = self.node.parent
+        if parent is None or len(parent.variations) < 2:
+            return False
+        siblings = parent.variations
+        sibling = siblings[(siblings.index(self.node) + step) % len(siblings)]
+        self._leave()
+        self._enter(sibling)
+        return True
+
+    def reset(self):
+        # The board object is kept, since the GUI holds on to it
+        self.game = chess.pgn.Game()
+        self.node = self.game
+        self.board.reset()
+        self._analysis.clear()
+        self._last_child.clear()
+        if self.log is not None:
+            self.log.reset()
+
+    def remember(self, elo_rating, best_moves, probabilities):
+        self._analysis[self.node, elo_rating] = (best_moves, probabilities)
+        if self.log is not None:
+            self.log.analysis(elo_rating, best_moves, probabilities)
+
+    def recall(self, elo_rating):
+        """Return the remembered analysis of the current node, or None."""
+        return self._analysis.get((self.node, elo_rating))
+
+    def remembered(self):
+        """Yield (node, elo_rating, best_moves, probabilities) for every node."""
+        for (node, elo_rating), (best_moves, probabilities) in self._analysis.items():
+            yield node, elo_rating, best_moves, probabilities
+
+    def _enter(self, child):
+        self.board.push(child.move)
+        self.node = child
+        if self.log is not None:
+            self.log.play(child.move)
+
+    def _leave(self):
+        self.board.pop()
+        self.node = self.node.parent
+        if self.log is not None:
+            self.log.back()
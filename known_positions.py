@@ -0,0 +1,140 @@
+"""Answers for book openings and tablebase endings without asking an engine.
+
+A Polyglot opening book gives the moves for the first plies. Syzygy
+tablebases give the best moves and the exact result once few pieces are
+left. Both are lookups of microseconds, against a second of Maia and a
+tenth of a second of Stockfish per position.
+
+    python maia_chess.py --book assets/books/book.bin --tablebases assets/syzygy
+"""
+
+import os
+import time
+import chess
+import chess.polyglot
+import chess.syzygy
+from perf import log_event
+
+BOOK_PATH = os.environ.get("MAIA_CHESS_BOOK")
+TABLEBASE_PATH = os.environ.get("MAIA_CHESS_SYZYGY")
+
+# Book moves are only looked up this far into the game
+BOOK_PLIES = 24
+
+# Tablebase results as (score, (win, draw, loss)) for the side to move.
+# Cursed wins and blessed losses are draws under the 50-move rule.
+TABLEBASE_RESULTS = {
+    2: (100.0, (1.0, 0.0, 0.0)),
+    1: (0.0, (0.0, 1.0, 0.0)),
+    0: (0.0, (0.0, 1.0, 0.0)),
+    -1: (0.0, (0.0, 1.0, 0.0)),
+    -2: (-100.0, (0.0, 0.0, 1.0)),
+}
+
+
+class KnownPositions:
+    """Looks positions up in an opening book and in tablebases.
+
+    lookup() returns (best_moves, probabilities) or None. Book moves are
+    ordered by weight and have None as score, since a book has no
+    evaluation, and come without probabilities, which the caller still gets
+    from an engine. Tablebase hits have both, with scores of 100.0 for a
+    won, 0.0 for a drawn and -100.0 for a lost move.
+
+    book_hits, tablebase_hits and misses count lookups; hits and misses make
+    it work with the HUD's cache_rate().
+    """
+
+    def __init__(self, book_path=BOOK_PATH, tablebase_path=TABLEBASE_PATH):
+        self.book = None
+        self.tablebase = None
+        self.max_pieces = 0
+        if book_path:
+            self.book = chess.polyglot.open_reader(book_path)  # Memory-mapped
+        if tablebase_path:
+            self.tablebase = chess.syzygy.open_tablebase(tablebase_path)
+            # Table names are pieces plus a "v", e.g. KRvK
+            self.max_pieces = max(
+                (len(name) - 1 for name in self.tablebase.wdl), default=0
+            )
+        self.book_hits = 0
+        self.tablebase_hits = 0
+        self.misses = 0
+
+    @property
+    def hits(self):
+        return self.book_hits + self.tablebase_hits
+
+    def __bool__(self):
+        return self.book is not None or self.tablebase is not None
+
+    def lookup(self, board, num_moves=3):
+        start = time.perf_counter()
+        source = "tablebase"
+        result = self._probe_tablebase(board, num_moves)
+        if result is None:
+            source = "book"
+            result = self._probe_book(board, num_moves)
+        if result is None:
+            self.misses += 1
+            return None
+        if source == "book":
+            self.book_hits += 1
+        else:
+            self.tablebase_hits += 1
+        log_event(
+            "known_position",
+            source=source,
+            lookup_us=round((time.perf_counter() - start) * 1e6, 1),
+        )
+        return result
+
+    def close(self):
+        if self.book is not None:
+            self.book.close()
+        if self.tablebase is not None:
+            self.tablebase.close()
+
+    def _probe_book(self, board, num_moves):
+        if self.book is None or board.ply() >= BOOK_PLIES:
+            return None
+        entries = sorted(
+            self.book.find_all(board), key=lambda entry: entry.weight, reverse=True
+        )
+        if not entries:
+            return None
+        best_moves = [(entry.move, None) for entry in entries]
+        return best_moves[:num_moves], None
+
+    def _probe_tablebase(self, board, num_moves):
+        if (
+            self.tablebase is None
+            or chess.popcount(board.occupied) > self.max_pieces
+            or board.castling_rights
+        ):
+            return None
+        wdl = self.tablebase.get_wdl(board)
+        if wdl is None:
+            return None  # Table not available
+        board = board.copy(stack=False)
+        ranked = []
+        for move in board.legal_moves:
+            board.push(move)
+            try:
+                mate = board.is_checkmate()
+                move_wdl = self.tablebase.get_wdl(board)
+                dtz = self.tablebase.get_dtz(board)
+            finally:
+                board.pop()
+            if move_wdl is None or dtz is None:
+                return None
+            # From the opponent's side: the best move leaves them the worst
+            # result, and the highest DTZ wins fastest or loses slowest. DTZ
+            # counts to the next zeroing move rather than to mate, so mates
+            # are ranked first explicitly.
+            ranked.append((-move_wdl, mate, dtz, move))
+        ranked.sort(key=lambda item: item[:3], reverse=True)
+        best_moves = [
+            (move, TABLEBASE_RESULTS[result][0]) for result, _, _, move in ranked
+        ]
+        return best_moves[:num_moves], TABLEBASE_RESULTS[wdl][1]
@@ -1,13 +1,37 @@
+import argparse
+import concurrent.futures
+import json
 import os
 import sys
+import time
 import pygame
 import chess
 import chess.engine
 import warnings
 import math
-
-# Initialize Pygame
-pygame.init()
+from analysis import (
+    ADAPTIVE_MAIA_LIMIT,
+    ADAPTIVE_STOCKFISH_LIMIT,
+    MAIA_LIMIT,
+    STOCKFISH_LIMIT,
+    AnalysisWorker,
+    TimeControl,
+)
+from analysis_server import RemoteAnalysisWorker
+from cache import AnalysisCache, LRUCache
+from game_tree import GameTree
+from known_positions import BOOK_PATH, TABLEBASE_PATH, KnownPositions
+from engines import (
+    MAIA_ELOS,
+    STOCKFISH_COMMAND,
+    MaiaEnginePool,
+    quit_engine,
+    start_stockfish,
+)
+from perf import FrameStats, enable_timing_log
+from replay import EventRecorder, EventReplay, load_events
+from session_log import SessionRecorder, load_session
+from sprites import get_atlas
 
 warnings.filterwarnings("ignore", category=UserWarning, module="pygame.image")
 
@@ -16,8 +40,16 @@ WIDTH, HEIGHT = 800, 1000  # Adjusted the width and height as per requirements
 SQ_SIZE = WIDTH // 8  # Square size for the chessboard
 BOARD_SIZE = 8 * SQ_SIZE
 INFO_HEIGHT = HEIGHT - BOARD_SIZE
-WINDOW = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Fořtí Chess Engine")
+WINDOW = None  # Created by init_display(), nothing is opened at import time
+
+
+def init_display():
+    global WINDOW
+    if WINDOW is None:
+        pygame.init()
+        WINDOW = pygame.display.set_mode((WIDTH, HEIGHT))
+        pygame.display.set_caption("Fořtí Chess Engine")
+    return WINDOW
 
 
 def resource_path(relative_path):
@@ -31,15 +63,51 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
-font = pygame.font.Font(resource_path("assets/fonts/IosevkaSlab-Regular.ttf"), 24)
-font = pygame.font.Font(resource_path("assets/fonts/IosevkaSlab-Regular.ttf"), 36)
+# Maia lines analysed in earlier sessions are kept here
+ANALYSIS_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".maia_chess", "analysis.sqlite3"
+)
+
+FONT_PATH = "assets/fonts/IosevkaSlab-Regular.ttf"
+FONTS = {}
+TEXT_CACHE = LRUCache(512)
+
+
+def get_font(size, path=FONT_PATH):
+    """Load a font once per (path, size) and reuse it afterwards"""
+    key = (path, size)
+    if key not in FONTS:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        FONTS[key] = pygame.font.Font(resource_path(path), size)
+    return FONTS[key]
+
+
+def render_text(text, size, color):
+    """Render text with the UI font, reusing surfaces rendered before"""
+    key = (text, size, tuple(color))
+    text_surface = TEXT_CACHE.get(key)
+    if text_surface is None:
+        text_surface = get_font(size).render(text, True, color)
+        TEXT_CACHE.put(key, text_surface)
+    return text_surface
+
+
+# Piece sprites, loaded by load_images()
+PIECE_SET = "cburnett"
+PIECE_ATLAS = None
+
+
+def load_images():
+    global PIECE_ATLAS
+    if PIECE_ATLAS is None:
+        PIECE_ATLAS = get_atlas(
+            SQ_SIZE,
+            resource_path(f"assets/images/svgs/{PIECE_SET}"),
+            resource_path("assets/images"),
+        )
+    return PIECE_ATLAS
 
-# Load images
-IMAGES = {}
-PIECES = ["wP", "bP", "wN", "bN", "wB", "bB", "wR", "bR", "wQ", "bQ", "wK", "bK"]
-for piece in PIECES:
-    image = pygame.image.load(resource_path(f"assets/images/{piece}.png"))
-    IMAGES[piece] = pygame.transform.smoothscale(image, (SQ_SIZE, SQ_SIZE))
 
 # Piece to image mapping
 piece_to_image = {
@@ -69,22 +137,21 @@ SELECTED_SQUARE_COLOR = pygame.Color(255, 109, 97, 128)
 
 
 # Draw the board
-def draw_board():
+def draw_board(window):
     colors = [pygame.Color(150, 150, 150), pygame.Color(120, 120, 120)]
     for r in range(8):
         for c in range(8):
             color = colors[(r + c) % 2]
             pygame.draw.rect(
-                WINDOW, color, pygame.Rect(c * SQ_SIZE, r * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+                window, color, pygame.Rect(c * SQ_SIZE, r * SQ_SIZE, SQ_SIZE, SQ_SIZE)
             )
 
 
-def draw_coordinates():
-    font = pygame.font.Font("assets/fonts/IosevkaSlab-Regular.ttf", 18)
+def draw_coordinates(window):
     for i in range(8):
         # Draw files (a-h) at the bottom of the board, aligned to the bottom-right of each square
-        file_label = font.render(chr(97 + i), True, pygame.Color(0, 0, 0))
-        WINDOW.blit(
+        file_label = render_text(chr(97 + i), 18, pygame.Color(0, 0, 0))
+        window.blit(
             file_label,
             (
                 (i + 1) * SQ_SIZE - file_label.get_width() - 2,
@@ -92,8 +159,8 @@ def draw_coordinates():
             ),
         )
         # Draw ranks (1-8) on the left side of the board, aligned to the top-left of each square
-        rank_label = font.render(str(8 - i), True, pygame.Color(0, 0, 0))
-        WINDOW.blit(rank_label, (5, i * SQ_SIZE + 5))
+        rank_label = render_text(str(8 - i), 18, pygame.Color(0, 0, 0))
+        window.blit(rank_label, (5, i * SQ_SIZE + 5))
 
 
 # Draw pieces
@@ -102,9 +169,8 @@ def draw_pieces(board):
         for c in range(8):
             piece = board.piece_at(chess.square(c, 7 - r))
             if piece:
-                piece_image = IMAGES[piece_to_image[piece.symbol()]]
-                WINDOW.blit(
-                    piece_image, pygame.Rect(c * SQ_SIZE, r * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+                PIECE_ATLAS.blit(
+                    WINDOW, piece_to_image[piece.symbol()], (c * SQ_SIZE, r * SQ_SIZE)
                 )
 
 
@@ -121,20 +187,19 @@ def highlight_selected_square(window, selected_square):
         )
 
 
-def highlight_legal_moves(window, board, selected_square):
+def highlight_legal_moves(window, move_index, selected_square):
     if selected_square is not None:
-        for move in board.legal_moves:
-            if move.from_square == selected_square:
-                x, y = (
-                    chess.square_file(move.to_square),
-                    7 - chess.square_rank(move.to_square),
-                )
-                pygame.draw.circle(
-                    window,
-                    LEGAL_MOVE_COLOR,
-                    (x * SQ_SIZE + SQ_SIZE // 2, y * SQ_SIZE + SQ_SIZE // 2),
-                    SQ_SIZE // 6,
-                )
+        for to_square in move_index.get(selected_square, ()):
+            x, y = (
+                chess.square_file(to_square),
+                7 - chess.square_rank(to_square),
+            )
+            pygame.draw.circle(
+                window,
+                LEGAL_MOVE_COLOR,
+                (x * SQ_SIZE + SQ_SIZE // 2, y * SQ_SIZE + SQ_SIZE // 2),
+                SQ_SIZE // 6,
+            )
 
 
 def draw_move_arrow(window, from_square, to_square, color=ARROW_COLOR):
@@ -196,9 +261,29 @@ def draw_arrows(window, best_moves):
         draw_move_arrow(window, move.from_square, move.to_square, ARROW_COLORS[idx])
 
 
+def build_move_index(board):
+    """Map each from_square to {to_square: [legal moves]} for one position"""
+    move_index = {}
+    for move in board.legal_moves:
+        targets = move_index.setdefault(move.from_square, {})
+        targets.setdefault(move.to_square, []).append(move)
+    return move_index
+
+
+def find_move(move_index, from_square, to_square, promotion=chess.QUEEN):
+    """Return the legal move between two squares, or None.
+
+    Pawn moves to the last rank promote to `promotion`.
+    """
+    for move in move_index.get(from_square, {}).get(to_square, ()):
+        if move.promotion in (None, promotion):
+            return move
+    return None
+
+
 # Handle user input
-def get_square_under_mouse():
-    mouse_pos = pygame.mouse.get_pos()
+def get_square_under_mouse(pos=None):
+    mouse_pos = pygame.mouse.get_pos() if pos is None else pos
     x, y = [int(v // SQ_SIZE) for v in mouse_pos]
     flipped_y = 7 - y
     if 0 <= x < 8 and 0 <= flipped_y < 8:
@@ -206,58 +291,59 @@ def get_square_under_mouse():
     return None
 
 
-def set_engine_parameters(engine, elo_rating):
-    if elo_rating < 1100 or elo_rating > 1900 or elo_rating % 100 != 0:
+def set_engine_parameters(engine_pool, elo_rating):
+    if elo_rating not in MAIA_ELOS:
         raise ValueError(
             "Invalid Elo rating. Please choose a rating between 1100 and 1900 in increments of 100."
         )
-    weights = f"assets/models/maia-{elo_rating}.pb.gz"
-    engine.quit()
-    engine = chess.engine.SimpleEngine.popen_uci(["lc0", f"--weights={weights}"])
-    engine.configure({"Threads": 1})
+    engine = engine_pool.get(elo_rating)
+    # Warm up the neighbouring levels so the next change is instant too, as
+    # many as fit in the pool's budget next to the active one
+    neighbours = [
+        elo for elo in (elo_rating - 100, elo_rating + 100) if elo in MAIA_ELOS
+    ]
+    engine_pool.prewarm(neighbours[: engine_pool.max_engines - 1])
     return engine
 
 
 def display_best_moves_text(best_moves):
-    font = pygame.font.Font("assets/fonts/IosevkaSlab-Regular.ttf", 24)
     text_y = BOARD_SIZE + 20  # Start below the board
     text_x = WIDTH // 2  # Start in the center of the bottom area
     for idx, (move, score) in enumerate(best_moves):
-        move_text = f"{idx+1}. {move.uci()} ({score:.2f})"
-        text_surface = font.render(move_text, True, pygame.Color(0, 0, 0))
+        # Book moves have no score
+        label = "book" if score is None else f"{score:.2f}"
+        move_text = f"{idx+1}. {move.uci()} ({label})"
+        text_surface = render_text(move_text, 24, pygame.Color(0, 0, 0))
         text_rect = text_surface.get_rect(center=(text_x, text_y))
         WINDOW.blit(text_surface, text_rect)
         text_y += 30
 
 
-def get_best_moves(engine, board, num_moves=3):
-    result = engine.analyse(board, chess.engine.Limit(time=1), multipv=num_moves)
-    best_moves = []
-    for info in result:
-        move = info["pv"][0]
-        score = info["score"].relative.score(mate_score=10000) / 100.0
-        best_moves.append((move, score))
-    return best_moves
-
-
-def elo_menu(window, current_elo):
-    menu_running = True
-    font = font = pygame.font.Font("assets/fonts/IosevkaSlab-Regular.ttf", 20)
+def elo_menu_buttons():
     button_width = 150
     button_height = 75
     button_spacing = 25
     buttons = []
-
     for i, elo in enumerate(range(1100, 2000, 100)):
         x = 100 + (i % 5) * (button_width + button_spacing)
         y = 100 + (i // 5) * (button_height + button_spacing)
         buttons.append((pygame.Rect(x, y, button_width, button_height), elo))
+    return buttons
+
+
+def elo_menu(window, current_elo, get_events=pygame.event.get):
+    """Let the user pick a Maia level and return it.
+
+    Escape keeps current_elo. Returns None if the window is closed, so the
+    caller can shut down the engines and the session log properly.
+    """
+    menu_running = True
+    buttons = elo_menu_buttons()
 
     while menu_running:
-        for event in pygame.event.get():
+        for event in get_events():
             if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
+                return None
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 menu_running = False
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -268,12 +354,12 @@ def elo_menu(window, current_elo):
         window.fill(pygame.Color(200, 200, 200))
         for button, elo in buttons:
             pygame.draw.rect(window, pygame.Color(0, 0, 255), button)
-            text_surface = font.render(f"Elo: {elo}", True, pygame.Color(0, 0, 0))
+            text_surface = render_text(f"Elo: {elo}", 20, pygame.Color(0, 0, 0))
             window.blit(
                 text_surface,
                 (
-                    button.x + (button_width - text_surface.get_width()) // 2,
-                    button.y + (button_height - text_surface.get_height()) // 2,
+                    button.x + (button.w - text_surface.get_width()) // 2,
+                    button.y + (button.h - text_surface.get_height()) // 2,
                 ),
             )
 
@@ -282,143 +368,594 @@ def elo_menu(window, current_elo):
     return current_elo  # If menu is exited without selection, return current ELO
 
 
-def evaluate_position(engine, board):
-    info = engine.analyse(board, chess.engine.Limit(time=0.1))
-    score = info["score"].relative.score(mate_score=10000)
-    if score is None:
-        print("Evaluation score is None")
-        return 0.5, 0.5, 0.0  # In case of an unknown score
-    print(f"Evaluation score: {score}")
-    win_prob = 1 / (1 + math.exp(-score / 400))
-    loss_prob = 1 - win_prob
-    draw_prob = 0.0  # For simplicity, you can refine this if needed
-    print(
-        f"Probabilities - Win: {win_prob:.2%}, Draw: {draw_prob:.2%}, Lose: {loss_prob:.2%}"
-    )
-    return win_prob, draw_prob, loss_prob
-
-
 def draw_probabilities(win_prob, draw_prob, loss_prob):
-    print("Drawing probabilities...")
-    font = pygame.font.Font("assets/fonts/IosevkaSlab-Regular.ttf", 24)
-    text_y = HEIGHT - INFO_HEIGHT + 200
-    text_x = WIDTH - 250
+    text_x = PROBABILITIES_AREA.x + 10
+    text_y = PROBABILITIES_AREA.y + 3
 
     win_text = f"Win: {win_prob:.2%}"
     draw_text = f"Draw: {draw_prob:.2%}"
     loss_text = f"Lose: {loss_prob:.2%}"
 
-    win_surface = font.render(win_text, True, pygame.Color(0, 0, 0))
-    draw_surface = font.render(draw_text, True, pygame.Color(0, 0, 0))
-    loss_surface = font.render(loss_text, True, pygame.Color(0, 0, 0))
+    win_surface = render_text(win_text, 24, pygame.Color(0, 0, 0))
+    draw_surface = render_text(draw_text, 24, pygame.Color(0, 0, 0))
+    loss_surface = render_text(loss_text, 24, pygame.Color(0, 0, 0))
 
     WINDOW.blit(win_surface, (text_x, text_y))
     WINDOW.blit(draw_surface, (text_x, text_y + 30))
     WINDOW.blit(loss_surface, (text_x, text_y + 60))
 
 
-def main():
-    board = chess.Board()
-    clock = pygame.time.Clock()
+# Info panel buttons and widget areas
+UNDO_BUTTON = pygame.Rect(10, HEIGHT - INFO_HEIGHT + 10, 175, 60)
+RESTART_BUTTON = pygame.Rect(WIDTH - 170, HEIGHT - INFO_HEIGHT + 10, 150, 60)
+MAKE_MOVE_BUTTON = pygame.Rect(WIDTH // 2 - 75, HEIGHT - INFO_HEIGHT + 140, 150, 40)
+INPUT_BOX = pygame.Rect(WIDTH // 2 - 125, HEIGHT - INFO_HEIGHT + 100, 150, 30)
+BEST_MOVES_AREA = pygame.Rect(3, BOARD_SIZE + 3, WIDTH - 6, 96)
+INPUT_AREA = pygame.Rect(INPUT_BOX.x, INPUT_BOX.y, WIDTH - 3 - INPUT_BOX.x, INPUT_BOX.h)
+PROBABILITIES_AREA = pygame.Rect(3, HEIGHT - INFO_HEIGHT + 100, 250, 94)
+HUD_AREA = pygame.Rect(5, 5, 390, 118)
 
-    selected_square = None
-    player_clicks = []
-    last_move = None
-    elo_rating = 1500
-    show_menu = False
 
-    # Move history for undo functionality
-    move_history = []
+def draw_undo_button(window):
+    pygame.draw.rect(window, pygame.Color(255, 0, 0), UNDO_BUTTON)
+    text_surface = render_text("Undo Move", 36, pygame.Color(255, 255, 255))
+    window.blit(text_surface, (UNDO_BUTTON.x + 5, UNDO_BUTTON.y + 5))
+
 
-    # Initialize the Maia engine with the default Elo rating
-    engine = chess.engine.SimpleEngine.popen_uci(
-        [
-            "lc0",
-            "--weights=assets/models/maia-1500.pb.gz",
-        ]
+def draw_restart_button(window):
+    pygame.draw.rect(window, pygame.Color(0, 0, 255), RESTART_BUTTON)
+    text_surface = render_text("Restart", 36, pygame.Color(255, 255, 255))
+    window.blit(text_surface, (RESTART_BUTTON.x + 5, RESTART_BUTTON.y + 5))
+
+
+def draw_make_move_button(window):
+    pygame.draw.rect(window, pygame.Color(0, 128, 0), MAKE_MOVE_BUTTON)
+    text_surface = render_text("Make Move", 24, pygame.Color(255, 255, 255))
+    window.blit(text_surface, (MAKE_MOVE_BUTTON.x + 20, MAKE_MOVE_BUTTON.y + 5))
+
+
+def draw_input_box(window, input_box, text, color):
+    pygame.draw.rect(window, color, input_box, 2)
+    text_surface = render_text(text, 24, color)
+    window.blit(text_surface, (input_box.x + 5, input_box.y + 5))
+    input_box.w = max(250, text_surface.get_width() + 5)
+
+
+def draw_hud(window, lines):
+    # Translucent so the board stays visible; text changes every frame, so it
+    # skips TEXT_CACHE
+    overlay = pygame.Surface(HUD_AREA.size, pygame.SRCALPHA)
+    overlay.fill((0, 0, 0, 170))
+    font = get_font(16)
+    for i, line in enumerate(lines):
+        overlay.blit(font.render(line, True, (255, 255, 255)), (6, 4 + i * 22))
+    window.blit(overlay, HUD_AREA)
+
+
+def cache_rate(cache):
+    lookups = cache.hits + cache.misses
+    return f"{cache.hits / lookups:.0%}" if lookups else "-"
+
+
+def search_summary(stats):
+    if stats is None:
+        return "-"
+    nps = stats["nps"]
+    return f"{stats['latency_ms']:.0f} ms, {nps if nps is not None else '-'} nps"
+
+
+def hud_lines(frame_stats, worker):
+    lines = [
+        f"FPS {frame_stats.fps():.1f}  frame p50/p95/p99 "
+        + "/".join(
+            f"{frame_stats.work_percentile(fraction) * 1000:.1f}"
+            for fraction in (0.5, 0.95, 0.99)
+        )
+        + " ms",
+        f"Maia {worker.elo_rating}: {search_summary(worker.search_stats.get('maia'))}",
+        f"Stockfish: {search_summary(worker.search_stats.get('stockfish'))}",
+        f"Cache hits: analysis {cache_rate(worker.analysis_cache.memory)}, "
+        f"eval {cache_rate(worker.evaluation_cache)}, text {cache_rate(TEXT_CACHE)}",
+    ]
+    known = worker.known_positions
+    if known:
+        lines.append(
+            f"Book {known.book_hits}, tablebase {known.tablebase_hits}, "
+            f"searched {known.misses}"
+        )
+    return lines
+
+
+def build_background():
+    # Everything that never changes: board squares, panel and its buttons
+    background = pygame.Surface((WIDTH, HEIGHT)).convert()
+    draw_board(background)
+    panel = pygame.Rect(0, BOARD_SIZE, WIDTH, INFO_HEIGHT)
+    pygame.draw.rect(background, pygame.Color(200, 200, 200), panel)
+    pygame.draw.rect(background, pygame.Color(0, 0, 0), panel, 3)
+    draw_undo_button(background)
+    draw_restart_button(background)
+    draw_make_move_button(background)
+    return background
+
+
+def build_coordinate_layer():
+    layer = pygame.Surface((BOARD_SIZE, BOARD_SIZE), pygame.SRCALPHA).convert_alpha()
+    draw_coordinates(layer)
+    return layer
+
+
+def square_rect(square):
+    return pygame.Rect(
+        chess.square_file(square) * SQ_SIZE,
+        (7 - chess.square_rank(square)) * SQ_SIZE,
+        SQ_SIZE,
+        SQ_SIZE,
     )
-    engine.configure({"Threads": 2})
 
-    stockfish_engine = chess.engine.SimpleEngine.popen_uci(
-        "/opt/homebrew/bin/stockfish"
+
+def arrow_rect(from_square, to_square):
+    # Both end squares plus room for the arrowhead overhanging the centres
+    return square_rect(from_square).union(square_rect(to_square)).inflate(40, 40)
+
+
+class Renderer:
+    """Retained-mode renderer that repaints only what changed since last frame.
+
+    Each region remembers the state it was last drawn with. render() compares
+    the new state against it, repaints the changed regions over the prebuilt
+    background and passes just those rects to pygame.display.update(). When
+    nothing changed it does no drawing at all. The performance HUD, when
+    shown, is repainted every frame.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.background = build_background()
+        self.coordinate_layer = build_coordinate_layer()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget what is on screen so the next render() repaints everything."""
+        self._board_state = None
+        self._widget_states = {}
+        self._hud_shown = False
+
+    def render(
+        self,
+        board,
+        move_index,
+        selected_square,
+        last_move,
+        best_moves,
+        probabilities,
+        input_box,
+        text,
+        color,
+        hud=None,
+    ):
+        full_redraw = self._board_state is None
+        if full_redraw:
+            self.window.blit(self.background, (0, 0))
+        dirty = self._render_board(
+            board, move_index, selected_square, last_move, best_moves
+        )
+        dirty += self._render_widget(
+            "best_moves",
+            BEST_MOVES_AREA,
+            tuple(best_moves),
+            display_best_moves_text,
+            best_moves,
+        )
+        dirty += self._render_widget(
+            "input",
+            INPUT_AREA,
+            (text, tuple(color)),
+            draw_input_box,
+            self.window,
+            input_box,
+            text,
+            color,
+        )
+        dirty += self._render_widget(
+            "probabilities",
+            PROBABILITIES_AREA,
+            probabilities,
+            draw_probabilities,
+            *(probabilities or ()),
+        )
+        if hud is not None or self._hud_shown:
+            dirty += self._render_hud(hud)
+        if full_redraw:
+            pygame.display.update()
+        elif dirty:
+            pygame.display.update(dirty)
+        return dirty
+
+    def _render_board(self, board, move_index, selected_square, last_move, best_moves):
+        legal_targets = ()
+        if selected_square is not None:
+            legal_targets = tuple(move_index.get(selected_square, ()))
+        arrows = [(move.from_square, move.to_square) for move, _ in best_moves]
+        if last_move:
+            arrows.append((last_move.from_square, last_move.to_square))
+        state = (board.piece_map(), selected_square, legal_targets, arrows)
+        self._board_args = (board, move_index, selected_square, last_move, best_moves)
+        old_state = self._board_state
+        if state == old_state:
+            return []
+        self._board_state = state
+
+        if old_state is None:
+            dirty = [pygame.Rect(0, 0, BOARD_SIZE, BOARD_SIZE)]
+        else:
+            old_pieces, old_selected, old_targets, old_arrows = old_state
+            pieces = state[0]
+            squares = {
+                square
+                for square in set(pieces) | set(old_pieces)
+                if pieces.get(square) != old_pieces.get(square)
+            }
+            if selected_square != old_selected or legal_targets != old_targets:
+                squares.update(
+                    s for s in (selected_square, old_selected) if s is not None
+                )
+                squares.update(legal_targets)
+                squares.update(old_targets)
+            dirty = [square_rect(square) for square in squares]
+            if arrows != old_arrows:
+                dirty += [arrow_rect(*arrow) for arrow in set(arrows) | set(old_arrows)]
+
+        area = dirty[0].unionall(dirty[1:]).clip(0, 0, BOARD_SIZE, BOARD_SIZE)
+        self._paint_board(area, *self._board_args)
+        return [rect.clip(area) for rect in dirty]
+
+    def _paint_board(
+        self, area, board, move_index, selected_square, last_move, best_moves
+    ):
+        self.window.set_clip(area)
+        self.window.blit(self.background, area, area)
+        highlight_selected_square(self.window, selected_square)
+        highlight_legal_moves(self.window, move_index, selected_square)
+        draw_pieces(board)
+        self.window.blit(self.coordinate_layer, area, area)
+        if last_move:
+            draw_move_arrow(self.window, last_move.from_square, last_move.to_square)
+        draw_arrows(self.window, best_moves)
+        self.window.set_clip(None)
+
+    def _render_hud(self, lines):
+        # lines of None hides the HUD, repainting the board underneath once
+        self._paint_board(HUD_AREA, *self._board_args)
+        self._hud_shown = lines is not None
+        if lines is not None:
+            draw_hud(self.window, lines)
+        return [HUD_AREA]
+
+    def _render_widget(self, name, area, state, draw, *args):
+        # A state of None leaves the widget blank
+        if name in self._widget_states and self._widget_states[name] == state:
+            return []
+        self._widget_states[name] = state
+        self.window.set_clip(area)
+        self.window.blit(self.background, area, area)
+        if state is not None:
+            draw(*args)
+        self.window.set_clip(None)
+        return [area]
+
+
+class ChessApp:
+    """Owns the window, assets and engines and creates them in start().
+
+    Importing this module loads nothing. start() opens the window and loads
+    the assets on the main thread while the lc0 and Stockfish processes spawn
+    on background threads, and records how long every step took in timings.
+    With server set, analysis comes from analysis_server.py at that address
+    and no engines are started. max_engines caps the lc0 processes kept
+    running for Elo changes.
+    """
+
+    def __init__(
+        self,
+        elo_rating=1500,
+        maia_limit=MAIA_LIMIT,
+        stockfish_limit=STOCKFISH_LIMIT,
+        lc0=None,
+        weights=None,
+        stockfish=STOCKFISH_COMMAND,
+        cache_path=ANALYSIS_CACHE_PATH,
+        server=None,
+        book=BOOK_PATH,
+        tablebases=TABLEBASE_PATH,
+        max_engines=3,
+    ):
+        self.elo_rating = elo_rating
+        self.maia_limit = maia_limit
+        self.stockfish_limit = stockfish_limit
+        self.lc0 = lc0
+        self.weights = weights
+        self.stockfish = stockfish
+        self.cache_path = cache_path
+        self.server = server
+        self.book = book
+        self.tablebases = tablebases
+        self.max_engines = max_engines
+        self.known_positions = None
+        self.session_log = None
+        self.timings = {}
+        self.window = None
+        self.renderer = None
+        self.engine_pool = None
+        self.stockfish_engine = None
+        self.analysis_cache = None
+        self.worker = None
+
+    def start(self):
+        start = time.perf_counter()
+        if self.server:
+            self._start_display()
+            self.worker = self.timed(
+                "server", RemoteAnalysisWorker, self.server, self.elo_rating
+            )
+            self.timings["start"] = time.perf_counter() - start
+            return self
+        self.engine_pool = MaiaEnginePool(
+            max_engines=self.max_engines,
+            threads=2,
+            lc0=self.lc0,
+            weights=self.weights,
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            maia = executor.submit(
+                self.timed,
+                "maia_engine",
+                set_engine_parameters,
+                self.engine_pool,
+                self.elo_rating,
+            )
+            stockfish = executor.submit(
+                self.timed,
+                "stockfish_engine",
+                start_stockfish,
+                self.stockfish,
+            )
+            self._start_display()
+            self.analysis_cache = self.timed(
+                "analysis_cache", AnalysisCache, 4096, self.cache_path
+            )
+            self.known_positions = self.timed(
+                "known_positions", KnownPositions, self.book, self.tablebases
+            )
+            engine = maia.result()
+            self.stockfish_engine = stockfish.result()
+        self.worker = AnalysisWorker(
+            engine,
+            self.stockfish_engine,
+            analysis_cache=self.analysis_cache,
+            elo_rating=self.elo_rating,
+            maia_limit=self.maia_limit,
+            stockfish_limit=self.stockfish_limit,
+            known_positions=self.known_positions,
+        )
+        self.timings["start"] = time.perf_counter() - start
+        return self
+
+    def set_elo(self, elo_rating):
+        """Switch Maia's level; request the position again afterwards."""
+        self.elo_rating = elo_rating
+        with self.worker.paused():
+            if self.engine_pool is not None:
+                self.worker.engine = set_engine_parameters(self.engine_pool, elo_rating)
+            self.worker.elo_rating = elo_rating
+
+    def close(self):
+        if self.session_log is not None:
+            self.session_log.close()
+        if self.worker is not None:
+            self.worker.close()
+        if self.analysis_cache is not None:
+            self.analysis_cache.close()
+        if self.known_positions is not None:
+            self.known_positions.close()
+        if self.stockfish_engine is not None:
+            quit_engine(self.stockfish_engine)
+        if self.engine_pool is not None:
+            self.engine_pool.close()
+
+    def _start_display(self):
+        self.window = self.timed("display", init_display)
+        self.timed("images", load_images)
+        self.renderer = self.timed("renderer", Renderer, self.window)
+
+    def report_timings(self):
+        # One JSON line on stderr, easy to collect from the frozen binary
+        timings = {name: round(seconds, 4) for name, seconds in self.timings.items()}
+        print(json.dumps({"startup_timings": timings}), file=sys.stderr)
+
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings[name] = time.perf_counter() - start
+        return result
+
+
+# Moving through the game tree: back, forward and between variations
+NAVIGATION_KEYS = {
+    pygame.K_LEFT: GameTree.back,
+    pygame.K_RIGHT: GameTree.forward,
+    pygame.K_UP: lambda tree: tree.switch_variation(-1),
+    pygame.K_DOWN: lambda tree: tree.switch_variation(1),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Play against Maia.")
+    parser.add_argument(
+        "--startup-timing",
+        action="store_true",
+        default=bool(os.environ.get("MAIA_CHESS_STARTUP_TIMING")),
+        help="print how long each startup step took",
+    )
+    parser.add_argument(
+        "--timing-log",
+        default=os.environ.get("MAIA_CHESS_TIMING_LOG"),
+        help="write one JSON line per frame and per search here",
+    )
+    parser.add_argument(
+        "--infinite-analysis",
+        action="store_true",
+        help="keep refining Maia's suggestions until the position changes",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=ADAPTIVE_MAIA_LIMIT.budget,
+        help="Maia's seconds per position; searches stop early when the lines "
+        "settle and run longer while scores swing (Stockfish gets a tenth)",
+    )
+    parser.add_argument(
+        "--fixed-time",
+        action="store_true",
+        help="always search for the full budget",
+    )
+    parser.add_argument("--lc0", help="lc0 command (default: $MAIA_CHESS_LC0 or lc0)")
+    parser.add_argument(
+        "--weights", help="Maia weights path, {elo_rating} is replaced by the level"
+    )
+    parser.add_argument(
+        "--stockfish",
+        default=STOCKFISH_COMMAND,
+        help="Stockfish command (default: $MAIA_CHESS_STOCKFISH)",
     )
+    parser.add_argument(
+        "--max-engines",
+        type=int,
+        default=3,
+        help="Maia levels kept running for Elo changes; 1 starts no other level "
+        "in advance",
+    )
+    parser.add_argument(
+        "--analysis-cache",
+        default=ANALYSIS_CACHE_PATH,
+        help="SQLite file for Maia lines, or an empty string to keep them in memory",
+    )
+    parser.add_argument(
+        "--book",
+        default=BOOK_PATH,
+        help="Polyglot opening book (default: $MAIA_CHESS_BOOK)",
+    )
+    parser.add_argument(
+        "--tablebases",
+        default=TABLEBASE_PATH,
+        help="Syzygy tablebase directory (default: $MAIA_CHESS_SYZYGY)",
+    )
+    parser.add_argument(
+        "--server",
+        help="get analysis from analysis_server.py at host:port or a socket path",
+    )
+    parser.add_argument(
+        "--session",
+        help="log the game and its analysis to this file, resuming it if it exists",
+    )
+    parser.add_argument("--record-events", help="save the input events to this file")
+    parser.add_argument(
+        "--replay-events", help="play back events saved with --record-events"
+    )
+    parser.add_argument(
+        "--fps", type=int, default=30, help="frame rate cap, 0 for none"
+    )
+    # The frozen app may be started with extra platform arguments
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.timing_log:
+        enable_timing_log(args.timing_log)
+    if args.fixed_time:
+        maia_limit = chess.engine.Limit(time=args.time_budget)
+        stockfish_limit = chess.engine.Limit(time=args.time_budget / 10)
+    else:
+        maia_limit = TimeControl(args.time_budget, ADAPTIVE_MAIA_LIMIT.minimum)
+        stockfish_limit = TimeControl(
+            args.time_budget / 10, ADAPTIVE_STOCKFISH_LIMIT.minimum
+        )
+    app = ChessApp(
+        maia_limit=None if args.infinite_analysis else maia_limit,
+        stockfish_limit=stockfish_limit,
+        lc0=args.lc0,
+        weights=args.weights,
+        stockfish=args.stockfish,
+        cache_path=args.analysis_cache or None,
+        server=args.server,
+        book=args.book,
+        tablebases=args.tablebases,
+        max_engines=args.max_engines,
+    ).start()
+    get_events = pygame.event.get
+    if args.replay_events:
+        get_events = EventReplay(load_events(args.replay_events))
+    if args.record_events:
+        get_events = EventRecorder(get_events, args.record_events)
+    tree = GameTree()
+    if args.session:
+        if os.path.exists(args.session):
+            tree = load_session(args.session)[-1]  # Carry on where it was left
+        app.session_log = tree.log = SessionRecorder(args.session)
+    board = tree.board  # Updated in place as the user moves through the tree
+    clock = pygame.time.Clock()
 
-    best_moves = get_best_moves(engine, board)
+    selected_square = None
+    player_clicks = []
+    elo_rating = app.elo_rating
+    show_menu = False
 
-    input_box = pygame.Rect(WIDTH // 2 - 125, HEIGHT - INFO_HEIGHT + 100, 150, 30)
+    worker = app.worker
+    analysed = None  # What worker.latest() belongs to
+    if tree.recall(elo_rating) is None:
+        worker.request(board)
+        analysed = (tree.node, elo_rating)
+    # Legal moves of the current position, rebuilt only when it changes
+    move_index = build_move_index(board)
+
+    input_box = INPUT_BOX.copy()
     color_inactive = pygame.Color("lightskyblue3")
     color_active = pygame.Color("dodgerblue2")
     color = color_inactive
     active = False
     text = ""
-    font = pygame.font.Font("assets/fonts/IosevkaSlab-Regular.ttf", 24)
+    renderer = app.renderer
+    # Performance HUD, toggled with F3
+    frame_stats = FrameStats()
+    show_hud = False
+
+    def latest_analysis():
+        # A node keeps the worker's results once they are final, so going
+        # back to it later needs no engine
+        remembered = tree.recall(elo_rating)
+        if remembered is not None:
+            return remembered
+        best_moves, probabilities = worker.latest()
+        if analysed == (tree.node, elo_rating) and worker.done():
+            tree.remember(elo_rating, best_moves, probabilities)
+        return best_moves, probabilities
 
     def redraw_all():
-        draw_board()
-        highlight_selected_square(WINDOW, selected_square)
-        highlight_legal_moves(WINDOW, board, selected_square)
-        draw_pieces(board)
-        draw_coordinates()
-        if last_move:
-            draw_move_arrow(WINDOW, last_move.from_square, last_move.to_square)
-        draw_arrows(WINDOW, best_moves)
-        pygame.draw.rect(
-            WINDOW,
-            pygame.Color(200, 200, 200),
-            pygame.Rect(0, BOARD_SIZE, WIDTH, INFO_HEIGHT),
-        )  # Clear the area for best moves
-        pygame.draw.rect(
-            WINDOW,
-            pygame.Color(0, 0, 0),
-            pygame.Rect(0, BOARD_SIZE, WIDTH, INFO_HEIGHT),
-            3,
-        )  # Black border around the bottom area
-        display_best_moves_text(best_moves)
-        draw_undo_button()
-        draw_restart_button()
-        draw_input_box()
-        draw_make_move_button()
-        win_prob, draw_prob, loss_prob = evaluate_position(stockfish_engine, board)
-        draw_probabilities(win_prob, draw_prob, loss_prob)
-        pygame.display.update()
-
-    def draw_undo_button():
-        undo_button = pygame.Rect(10, HEIGHT - INFO_HEIGHT + 10, 175, 60)
-        pygame.draw.rect(WINDOW, pygame.Color(255, 0, 0), undo_button)
-        font = pygame.font.Font(
-            resource_path("assets/fonts/IosevkaSlab-Regular.ttf"), 36
-        )
-        text_surface = font.render("Undo Move", True, pygame.Color(255, 255, 255))
-        WINDOW.blit(text_surface, (undo_button.x + 5, undo_button.y + 5))
-        return undo_button
-
-    def draw_restart_button():
-        restart_button = pygame.Rect(WIDTH - 170, HEIGHT - INFO_HEIGHT + 10, 150, 60)
-        pygame.draw.rect(WINDOW, pygame.Color(0, 0, 255), restart_button)
-        font = pygame.font.Font(
-            resource_path("assets/fonts/IosevkaSlab-Regular.ttf"), 36
+        best_moves, probabilities = latest_analysis()
+        renderer.render(
+            board,
+            move_index,
+            selected_square,
+            tree.last_move,
+            best_moves,
+            probabilities,
+            input_box,
+            text,
+            color,
+            hud_lines(frame_stats, worker) if show_hud else None,
         )
-        text_surface = font.render("Restart", True, pygame.Color(255, 255, 255))
-        WINDOW.blit(text_surface, (restart_button.x + 5, restart_button.y + 5))
-        return restart_button
-
-    def draw_input_box():
-        pygame.draw.rect(WINDOW, color, input_box, 2)
-        text_surface = font.render(text, True, color)
-        WINDOW.blit(text_surface, (input_box.x + 5, input_box.y + 5))
-        input_box.w = max(250, text_surface.get_width() + 5)
-
-    def draw_make_move_button():
-        make_move_button = pygame.Rect(
-            WIDTH // 2 - 75, HEIGHT - INFO_HEIGHT + 140, 150, 40
-        )
-        pygame.draw.rect(WINDOW, pygame.Color(0, 128, 0), make_move_button)
-        font = pygame.font.Font(
-            resource_path("assets/fonts/IosevkaSlab-Regular.ttf"), 24
-        )
-        text_surface = font.render("Make Move", True, pygame.Color(255, 255, 255))
-        WINDOW.blit(text_surface, (make_move_button.x + 20, make_move_button.y + 5))
-        return make_move_button
 
     def handle_text_input(event):
         nonlocal text, active, color
@@ -438,69 +975,100 @@ def main():
                     text += event.unicode
         return None
 
+    def position_changed():
+        nonlocal move_index, analysed
+        move_index = build_move_index(board)
+        if tree.recall(elo_rating) is None:
+            worker.request(board)
+            analysed = (tree.node, elo_rating)
+
     def make_move_from_input(move_text):
         try:
             move = chess.Move.from_uci(move_text)
-            if move in board.legal_moves:
-                board.push(move)
-                move_history.append(move)
+            move = find_move(
+                move_index,
+                move.from_square,
+                move.to_square,
+                move.promotion or chess.QUEEN,
+            )
+            if move is not None:
+                tree.play(move)
                 return True
         except Exception:
             return False
         return False
 
+    def quit_app():
+        # Flushes the session log and stops the engines before exiting
+        pygame.quit()
+        app.close()
+        sys.exit()
+
     # Initial drawing
-    redraw_all()
+    app.timed("first_frame", redraw_all)
+    if args.startup_timing:
+        app.report_timings()
 
     while not board.is_game_over():
-        for event in pygame.event.get():
+        frame_start = time.perf_counter()
+        events = get_events()
+        for event in events:
             if event.type == pygame.QUIT:
-                pygame.quit()
-                engine.quit()
-                stockfish_engine.quit()
-                sys.exit()
+                quit_app()
+            elif event.type == pygame.WINDOWEXPOSED:
+                renderer.invalidate()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_hud = not show_hud
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 show_menu = not show_menu
                 if show_menu:
-                    elo_rating = elo_menu(WINDOW, elo_rating)
-                    engine = set_engine_parameters(engine, elo_rating)
-                    best_moves = get_best_moves(engine, board)
+                    selected = elo_menu(app.window, elo_rating, get_events)
+                    if selected is None:
+                        quit_app()
+                    elo_rating = selected
+                    app.set_elo(elo_rating)
+                    position_changed()  # Same position, new Maia level
                     show_menu = False
+                    renderer.invalidate()
+                    redraw_all()
+            elif (
+                event.type == pygame.KEYDOWN
+                and event.key in NAVIGATION_KEYS
+                and not active
+            ):
+                if NAVIGATION_KEYS[event.key](tree):
+                    selected_square = None
+                    player_clicks = []
+                    position_changed()
                     redraw_all()
             elif event.type == pygame.MOUSEBUTTONDOWN and not show_menu:
-                if draw_undo_button().collidepoint(event.pos):
-                    if move_history:
-                        board.pop()
-                        move_history.pop()
-                        last_move = move_history[-1] if move_history else None
-                        best_moves = get_best_moves(engine, board)
+                if UNDO_BUTTON.collidepoint(event.pos):
+                    if tree.back():
+                        position_changed()
                         redraw_all()
-                elif draw_restart_button().collidepoint(event.pos):
-                    board.reset()
-                    move_history.clear()
-                    last_move = None
-                    best_moves = get_best_moves(engine, board)
+                elif RESTART_BUTTON.collidepoint(event.pos):
+                    tree.reset()
+                    position_changed()
                     redraw_all()
-                elif draw_make_move_button().collidepoint(event.pos):
+                elif MAKE_MOVE_BUTTON.collidepoint(event.pos):
                     if make_move_from_input(text):
-                        last_move = move_history[-1] if move_history else None
-                        best_moves = get_best_moves(engine, board)
+                        position_changed()
                         text = ""
                         redraw_all()
                 else:
-                    square = get_square_under_mouse()
-                    if square:
+                    square = get_square_under_mouse(event.pos)
+                    if square is not None:
                         if selected_square is None:
                             selected_square = square
                             player_clicks.append(square)
                         else:
                             player_clicks.append(square)
-                            move = chess.Move(player_clicks[0], player_clicks[1])
-                            if move in board.legal_moves:
-                                board.push(move)
-                                move_history.append(move)
-                                last_move = move
-                                best_moves = get_best_moves(engine, board)
+                            move = find_move(
+                                move_index, player_clicks[0], player_clicks[1]
+                            )
+                            if move is not None:
+                                tree.play(move)
+                                position_changed()
                                 selected_square = None
                                 player_clicks = []
                                 redraw_all()
@@ -511,18 +1079,17 @@ def main():
             input_move = handle_text_input(event)
             if input_move:
                 if make_move_from_input(input_move):
-                    last_move = move_history[-1] if move_history else None
-                    best_moves = get_best_moves(engine, board)
+                    position_changed()
                     text = ""
                     redraw_all()
 
         if not show_menu:
             redraw_all()
 
-        clock.tick(30)
+        work = time.perf_counter() - frame_start
+        frame_stats.record(work, clock.tick(args.fps) / 1000, events=len(events))
 
-    stockfish_engine.quit()
-    engine.quit()
+    app.close()
 
 
 if __name__ == "__main__":
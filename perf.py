@@ -0,0 +1,71 @@
+"""Frame and search timings for the on-screen HUD and the JSONL timing log.
+
+Records go to the "maia_chess.perf" logger, which is silent until
+enable_timing_log() attaches a file handler writing one JSON object per line:
+
+    {"time": 1760000000.1234, "event": "frame", "work_ms": 1.4, "interval_ms": 33.3}
+    {"time": 1760000000.5678, "event": "search", "engine": "maia", "latency_ms": 1002.1, ...}
+"""
+
+import collections
+import json
+import logging
+
+logger = logging.getLogger("maia_chess.perf")
+
+
+class JsonlFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 4), "event": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry)
+
+
+def enable_timing_log(path):
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(JsonlFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return handler
+
+
+def log_event(event, **fields):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(event, extra={"fields": fields})
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FrameStats:
+    """Rolling window of frame timings.
+
+    work is the time the loop spent handling events and drawing, interval the
+    wall time between frames including the frame limiter's sleep.
+    """
+
+    def __init__(self, window=300):
+        self.work_times = collections.deque(maxlen=window)
+        self.intervals = collections.deque(maxlen=window)
+
+    def record(self, work, interval, **fields):
+        self.work_times.append(work)
+        self.intervals.append(interval)
+        log_event(
+            "frame",
+            work_ms=round(work * 1000, 2),
+            interval_ms=round(interval * 1000, 2),
+            **fields,
+        )
+
+    def fps(self):
+        total = sum(self.intervals)
+        return len(self.intervals) / total if total else 0.0
+
+    def work_percentile(self, fraction):
+        return percentile(self.work_times, fraction)
@@ -0,0 +1,259 @@
+"""Record and replay GUI input, and load-test the event loop with it.
+
+maia_chess.py --record-events FILE saves every click and key press as one JSON
+line per event, numbered by the frame (call of the event source) it arrived
+in. --replay-events FILE feeds them back in the same frames, ignoring live
+input, and quits after the last one.
+
+Scripts can also be generated: random legal moves, undos, restarts and Elo
+switches from a seeded random generator. "run" replays a script as fast as
+possible against fake_engine.py and summarises the per-frame timings:
+
+    python replay.py generate --actions 5000 --seed 1 -o script.jsonl
+    python replay.py run script.jsonl --latency 0.01
+    python replay.py run script.jsonl --engine-args "--crash-after 300"
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+# pygame's import banner would end up in the JSON summary on stdout
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import pygame
+import chess
+
+# Only events the GUI reacts to are recorded
+RECORDED_EVENTS = {
+    pygame.MOUSEBUTTONDOWN: ("MOUSEBUTTONDOWN", ("pos", "button")),
+    pygame.KEYDOWN: ("KEYDOWN", ("key", "mod", "unicode")),
+    pygame.WINDOWEXPOSED: ("WINDOWEXPOSED", ()),
+    pygame.QUIT: ("QUIT", ()),
+}
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FAKE_ENGINE = os.path.join(ROOT, "fake_engine.py")
+
+
+def event_record(frame, event):
+    name, fields = RECORDED_EVENTS[event.type]
+    record = {"frame": frame, "type": name}
+    for field in fields:
+        value = getattr(event, field)
+        record[field] = list(value) if isinstance(value, tuple) else value
+    return record
+
+
+def make_event(record):
+    attributes = {
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in record.items()
+        if key not in ("frame", "type")
+    }
+    return pygame.event.Event(getattr(pygame, record["type"]), attributes)
+
+
+def load_events(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_events(records, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+class EventRecorder:
+    """Wraps an event source such as pygame.event.get and saves what it returns."""
+
+    def __init__(self, get_events, path):
+        self.get_events = get_events
+        self.file = open(path, "w", encoding="utf-8")
+        self.frame = 0
+
+    def __call__(self):
+        events = self.get_events()
+        recorded = False
+        for event in events:
+            if event.type in RECORDED_EVENTS:
+                self.file.write(json.dumps(event_record(self.frame, event)) + "\n")
+                recorded = True
+        if recorded:
+            self.file.flush()
+        self.frame += 1
+        return events
+
+
+class EventReplay:
+    """Event source returning recorded events in the frames they were recorded in."""
+
+    def __init__(self, records):
+        self.frames = {}
+        for record in records:
+            self.frames.setdefault(record["frame"], []).append(record)
+        self.last_frame = max(self.frames, default=-1)
+        self.frame = 0
+
+    def __call__(self):
+        pygame.event.clear()  # Live input would make the run differ
+        if self.frame > self.last_frame:
+            return [pygame.event.Event(pygame.QUIT)]
+        events = [make_event(record) for record in self.frames.get(self.frame, ())]
+        self.frame += 1
+        return events
+
+
+def generate_script(actions, seed=0, idle_frames=1, elo_switches=0.03, undos=0.2):
+    """Return event records for a random but legal sequence of actions.
+
+    The board is played along so every click lands on a legal move, and moves
+    that would end the game are never picked since that ends main().
+    """
+    import maia_chess  # For the board and button geometry
+
+    rng = random.Random(seed)
+    board = chess.Board()
+    records = []
+    frame = 0
+
+    def click(pos):
+        records.append(
+            {"frame": frame, "type": "MOUSEBUTTONDOWN", "pos": list(pos), "button": 1}
+        )
+
+    for _ in range(actions):
+        roll = rng.random()
+        if roll < elo_switches:
+            # Escape opens the menu, which reads the next frame's events
+            records.append(
+                {
+                    "frame": frame,
+                    "type": "KEYDOWN",
+                    "key": pygame.K_ESCAPE,
+                    "mod": 0,
+                    "unicode": "\x1b",
+                }
+            )
+            frame += 1
+            button, _ = rng.choice(maia_chess.elo_menu_buttons())
+            click(button.center)
+        elif roll < elo_switches + undos and board.move_stack:
+            click(maia_chess.UNDO_BUTTON.center)
+            board.pop()
+        else:
+            moves = []
+            for move in board.legal_moves:
+                if move.promotion not in (None, chess.QUEEN):
+                    continue
+                board.push(move)
+                if not board.is_game_over():
+                    moves.append(move)
+                board.pop()
+            if not moves:
+                click(maia_chess.RESTART_BUTTON.center)
+                board.reset()
+            else:
+                move = rng.choice(moves)
+                click(maia_chess.square_rect(move.from_square).center)
+                frame += 1
+                click(maia_chess.square_rect(move.to_square).center)
+                board.push(move)
+        frame += 1 + idle_frames
+    return records
+
+
+def summarise(log_path):
+    frames, searches = [], {}
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["event"] == "frame":
+                frames.append(record)
+            elif record["event"] == "search" and not record["speculative"]:
+                searches[record["engine"]] = searches.get(record["engine"], 0) + 1
+    busy = sorted(record["work_ms"] for record in frames if record.get("events"))
+
+    def at(fraction):
+        return busy[min(len(busy) - 1, int(fraction * len(busy)))] if busy else None
+
+    return {
+        "frames": len(frames),
+        "frames_with_events": len(busy),
+        "events": sum(record.get("events", 0) for record in frames),
+        "seconds": round(sum(record["interval_ms"] for record in frames) / 1000, 2),
+        "event_frame_ms": {
+            "p50": at(0.5),
+            "p95": at(0.95),
+            "p99": at(0.99),
+            "max": busy[-1] if busy else None,
+        },
+        "searches": searches,
+    }
+
+
+def run_script(script, latency=0.01, engine_args=""):
+    """Replay script in this process with fake engines and return a summary."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    os.chdir(ROOT)
+    import maia_chess
+
+    engine = f'"{sys.executable}" "{FAKE_ENGINE}" --latency {latency} {engine_args}'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log_path = os.path.join(temp_dir, "timing.jsonl")
+        argv = [
+            "--replay-events",
+            script,
+            "--lc0",
+            engine,
+            "--stockfish",
+            engine,
+            "--timing-log",
+            log_path,
+            "--analysis-cache",
+            "",
+            "--fps",
+            "0",
+        ]
+        try:
+            maia_chess.main(argv)
+        except SystemExit:
+            pass
+        return summarise(log_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate and replay scripted GUI input."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="write a random input script")
+    generate.add_argument("--actions", type=int, default=1000)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--idle-frames", type=int, default=1)
+    generate.add_argument("-o", "--output", required=True)
+    run = commands.add_parser("run", help="replay a script headlessly")
+    run.add_argument("script")
+    run.add_argument("--latency", type=float, default=0.01)
+    run.add_argument("--engine-args", default="", help="extra fake_engine.py options")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        records = generate_script(args.actions, args.seed, args.idle_frames)
+        save_events(records, args.output)
+        frames = records[-1]["frame"] + 1 if records else 0
+        print(f"{len(records)} events in {frames} frames")
+    else:
+        print(
+            json.dumps(
+                run_script(args.script, args.latency, args.engine_args), indent=2
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Sessions saved as a compact binary log, and replayed or exported from it.
+
+maia_chess.py --session FILE appends every step through the game tree to
+FILE, together with the analysis shown for each position. Opening the same
+file again restores the game, its variations and the analysis, and carries
+on appending. The file is a 16-byte header followed by fixed-width records:
+
+    op          B   PLAY, BACK, RESET or ANALYSIS
+    elo         H   Maia level of an ANALYSIS record
+    time_ms     I   since the session was first started
+    move        H   PLAY's move: from | to << 6 | promotion << 12, 0 for none
+    best_moves  3 x (H move, h centipawns, -32768 for a book move)
+    wdl         3 x H, in 1/10000, 0xFFFF when unknown
+
+A record torn by a crash at the end of the file is ignored, and cut off
+when the session is resumed. Records that do not fit the game, such as a
+move that is not legal where it was played, are skipped.
+
+    python session_log.py show session.bin
+    python session_log.py export session.bin -o session.pgn
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+import chess
+from game_tree import GameTree
+
+MAGIC = b"MAIASES1"
+HEADER = struct.Struct("<8sd")  # Magic, start time
+RECORD = struct.Struct("<BxHIH" + "Hh" * 3 + "HHH")
+MAX_MOVES = 3
+NO_WDL = 0xFFFF
+NO_SCORE = -0x8000
+
+PLAY, BACK, RESET, ANALYSIS = 1, 2, 3, 4
+OP_NAMES = {PLAY: "play", BACK: "back", RESET: "reset", ANALYSIS: "analysis"}
+
+# Seconds between background writes
+FLUSH_INTERVAL = 0.5
+
+
+def encode_move(move):
+    if move is None:
+        return 0
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code):
+    if not code:
+        return None
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+def pack_record(op, elo_rating=0, time_ms=0, move=None, best_moves=(), wdl=None):
+    moves = []
+    for best_move, score in list(best_moves)[:MAX_MOVES]:
+        if score is None:
+            centipawns = NO_SCORE
+        else:
+            centipawns = max(NO_SCORE + 1, min(32767, round(score * 100)))
+        moves += [encode_move(best_move), centipawns]
+    moves += [0, 0] * (MAX_MOVES - len(moves) // 2)
+    if wdl is None:
+        wdl = (NO_WDL,) * 3
+    else:
+        wdl = [round(probability * 10000) for probability in wdl]
+    return RECORD.pack(op, elo_rating, time_ms, encode_move(move), *moves, *wdl)
+
+
+def unpack_record(buffer, offset):
+    fields = RECORD.unpack_from(buffer, offset)
+    op, elo_rating, time_ms, move = fields[:4]
+    pairs = fields[4 : 4 + 2 * MAX_MOVES]
+    best_moves = [
+        (decode_move(code), None if centipawns == NO_SCORE else centipawns / 100)
+        for code, centipawns in zip(pairs[::2], pairs[1::2])
+        if code
+    ]
+    wdl = fields[4 + 2 * MAX_MOVES :]
+    probabilities = None if wdl[0] == NO_WDL else tuple(p / 10000 for p in wdl)
+    return op, elo_rating, time_ms, decode_move(move), best_moves, probabilities
+
+
+class SessionRecorder:
+    """Appends game tree steps to a session log; see GameTree.log.
+
+    Records are packed on the caller's thread, which only takes
+    microseconds, and written and flushed by a background thread every
+    FLUSH_INTERVAL seconds, so the frame loop never waits for the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER.size:
+            self.started = read_header(path)
+            # Drop a record torn by a crash, so new ones are appended aligned
+            records = (os.path.getsize(path) - HEADER.size) // RECORD.size
+            os.truncate(path, HEADER.size + records * RECORD.size)
+        else:
+            self.started = time.time()
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, self.started))
+        self._file = open(path, "ab")
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="session-log", daemon=True
+        )
+        self._thread.start()
+
+    def play(self, move):
+        self._append(pack_record(PLAY, time_ms=self._now(), move=move))
+
+    def back(self):
+        self._append(pack_record(BACK, time_ms=self._now()))
+
+    def reset(self):
+        self._append(pack_record(RESET, time_ms=self._now()))
+
+    def analysis(self, elo_rating, best_moves, probabilities):
+        self._append(
+            pack_record(
+                ANALYSIS, elo_rating, self._now(), None, best_moves, probabilities
+            )
+        )
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self._write()
+        self._file.close()
+
+    def _now(self):
+        return int((time.time() - self.started) * 1000)
+
+    def _append(self, record):
+        with self._lock:
+            self._pending.append(record)
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._write()
+
+    def _write(self):
+        with self._lock:
+            records, self._pending = self._pending, []
+        if records:
+            self._file.write(b"".join(records))
+            self._file.flush()
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(f"{path} has no complete session header")
+    magic, started = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a session log")
+    return started
+
+
+class SessionLog:
+    """Read-only, memory-mapped view of a session log's records.
+
+    Records are decoded on access as (op, elo_rating, time_ms, move,
+    best_moves, probabilities), so opening a long session costs nothing.
+    """
+
+    def __init__(self, path):
+        self.started = read_header(path)
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return (len(self._map) - HEADER.size) // RECORD.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return unpack_record(self._map, HEADER.size + index * RECORD.size)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def close(self):
+        self._map.close()
+
+
+def load_session(path):
+    """Return the games of a session as GameTrees, in order.
+
+    Every RESET starts a new game. The last tree is where the session left
+    off, with the current node and remembered analysis as they were. A file
+    without a complete header, left by a crash while it was created, holds
+    one empty game, as SessionRecorder starts it afresh.
+    """
+    trees = [GameTree()]
+    if os.path.getsize(path) < HEADER.size:
+        return trees
+    log = SessionLog(path)
+    try:
+        for op, elo_rating, _, move, best_moves, probabilities in log:
+            tree = trees[-1]
+            if op == PLAY:
+                if move is not None and tree.board.is_legal(move):
+                    tree.play(move)
+            elif op == BACK:
+                tree.back()
+            elif op == RESET:
+                trees.append(GameTree())
+            elif op == ANALYSIS:
+                best_moves = [
+                    (move, score)
+                    for move, score in best_moves
+                    if tree.board.is_legal(move)
+                ]
+                tree.remember(elo_rating, best_moves, probabilities)
+    finally:
+        log.close()
+    return trees
+
+
+def annotate(tree):
+    """Write the remembered analysis into the PGN comments of tree.game."""
+    comments = {}
+    for node, elo_rating, best_moves, probabilities in tree.remembered():
+        board = node.board()
+        if best_moves and best_moves[0][1] is None:
+            # Book moves, the same at every level
+            comment = "Book: " + ", ".join(board.san(move) for move, _ in best_moves)
+        else:
+            suggestions = ", ".join(
+                f"{board.san(move)} ({score:.2f})" for move, score in best_moves
+            )
+            comment = f"Maia {elo_rating}: {suggestions}"
+        if probabilities is not None:
+            win_prob, draw_prob, loss_prob = probabilities
+            comment += f"; W {win_prob:.1%} D {draw_prob:.1%} L {loss_prob:.1%}"
+        node_comments = comments.setdefault(node, [])
+        if comment not in node_comments:
+            node_comments.append(comment)
+    for node, node_comments in comments.items():
+        node.comment = " ".join(node_comments)
+    return tree.game
+
+
+def export_pgn(path, output):
+    games = [annotate(tree) for tree in load_session(path) if tree.game.variations]
+    with open(output, "w", encoding="utf-8") as f:
+        for game in games:
+            f.write(str(game) + "\n\n")
+    return len(games)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and export session logs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show = commands.add_parser("show", help="print the records")
+    show.add_argument("session")
+    export = commands.add_parser("export", help="write the games as annotated PGN")
+    export.add_argument("session")
+    export.add_argument("-o", "--output", required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        try:
+            log = SessionLog(args.session)
+        except ValueError as e:
+            parser.error(str(e))
+        for op, elo_rating, time_ms, move, best_moves, probabilities in log:
+            fields = [f"{time_ms / 1000:9.3f}", OP_NAMES.get(op, str(op))]
+            if move is not None:
+                fields.append(move.uci())
+            if op == ANALYSIS:
+                fields.append(str(elo_rating))
+                fields.extend(
+                    f"{m.uci()} book" if score is None else f"{m.uci()} {score:.2f}"
+                    for m, score in best_moves
+                )
+                if probabilities is not None:
+                    fields.append(
+                        "W/D/L " + "/".join(f"{p:.1%}" for p in probabilities)
+                    )
+            print("  ".join(fields))
+        log.close()
+    else:
+        print(f"{export_pgn(args.session, args.output)} games written")
+
+
+if __name__ == "__main__":
+    main()
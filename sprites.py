@@ -0,0 +1,103 @@
+import hashlib
+import io
+import os
+import pygame
+
+try:
+    import cairosvg
+except (ImportError, OSError):
+    # cairosvg is optional; without it atlases are built from the PNG set
+    cairosvg = None
+
+PIECES = ["wP", "bP", "wN", "bN", "wB", "bB", "wR", "bR", "wQ", "bQ", "wK", "bK"]
+ATLAS_COLUMNS = 6
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".maia_chess", "sprites")
+
+# Atlases already loaded in this process, keyed by (square size, sources)
+_atlases = {}
+
+
+class SpriteAtlas:
+    """All twelve piece sprites packed into one converted surface.
+
+    rects maps piece names ("wP", "bK", ...) to their area in surface, so a
+    piece is drawn with window.blit(atlas.surface, position, atlas.rects[name]).
+    """
+
+    def __init__(self, surface, square_size):
+        self.surface = surface
+        self.square_size = square_size
+        self.rects = {
+            piece: pygame.Rect(
+                (i % ATLAS_COLUMNS) * square_size,
+                (i // ATLAS_COLUMNS) * square_size,
+                square_size,
+                square_size,
+            )
+            for i, piece in enumerate(PIECES)
+        }
+
+    def blit(self, window, piece, position):
+        window.blit(self.surface, position, self.rects[piece])
+
+
+def get_atlas(square_size, svg_dir, png_dir):
+    """Return the atlas for square_size, building it at most once per size.
+
+    Sprites are rasterised from the SVGs in svg_dir when cairosvg is
+    available, otherwise scaled down from the PNGs in png_dir. Built atlases
+    are saved under CACHE_DIR named by size and a hash of the source files,
+    so later runs (and other window sizes seen before) load a single PNG.
+    Must be called after the display has been created.
+    """
+    key = (square_size, svg_dir, png_dir)
+    if key not in _atlases:
+        _atlases[key] = _load_atlas(square_size, svg_dir, png_dir)
+    return _atlases[key]
+
+
+def _load_atlas(square_size, svg_dir, png_dir):
+    if cairosvg is not None:
+        sources = [os.path.join(svg_dir, f"{piece}.svg") for piece in PIECES]
+    else:
+        sources = [os.path.join(png_dir, f"{piece}.png") for piece in PIECES]
+    digest = hashlib.sha1()
+    for path in sources:
+        with open(path, "rb") as source:
+            digest.update(source.read())
+    cache_path = os.path.join(
+        CACHE_DIR, f"atlas-{square_size}-{digest.hexdigest()[:16]}.png"
+    )
+
+    if os.path.exists(cache_path):
+        try:
+            surface = pygame.image.load(cache_path).convert_alpha()
+            return SpriteAtlas(surface, square_size)
+        except pygame.error:
+            pass  # Unreadable cache file, build it again
+
+    rows = -(-len(PIECES) // ATLAS_COLUMNS)
+    surface = pygame.Surface(
+        (ATLAS_COLUMNS * square_size, rows * square_size), pygame.SRCALPHA
+    )
+    atlas = SpriteAtlas(surface, square_size)
+    for piece, path in zip(PIECES, sources):
+        surface.blit(_rasterize(path, square_size), atlas.rects[piece])
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp.png"
+    pygame.image.save(surface, temp_path)
+    os.replace(temp_path, cache_path)
+
+    atlas.surface = surface.convert_alpha()
+    return atlas
+
+
+def _rasterize(path, square_size):
+    if path.endswith(".svg"):
+        png = cairosvg.svg2png(
+            url=path, output_width=square_size, output_height=square_size
+        )
+        return pygame.image.load(io.BytesIO(png), "sprite.png")
+    image = pygame.image.load(path)
+    return pygame.transform.smoothscale(image, (square_size, square_size))
@@ -0,0 +1,43 @@
+import os
+import sys
+import chess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_log import PLAY, SessionLog, SessionRecorder, load_session, pack_record
+
+
+def record(path, *moves):
+    recorder = SessionRecorder(path)
+    for move in moves:
+        recorder.play(chess.Move.from_uci(move))
+    recorder.close()
+
+
+def played(tree):
+    return [move.uci() for move in tree.board.move_stack]
+
+
+def test_resume_after_torn_record(tmp_path):
+    path = str(tmp_path / "session.bin")
+    record(path, "e2e4", "e7e5")
+    with open(path, "ab") as f:
+        f.write(b"\x01\x00\x01")  # A record torn by a crash
+    assert played(load_session(path)[-1]) == ["e2e4", "e7e5"]
+
+    record(path, "g1f3")
+    log = SessionLog(path)
+    assert [entry[3].uci() for entry in log] == ["e2e4", "e7e5", "g1f3"]
+    log.close()
+    assert played(load_session(path)[-1]) == ["e2e4", "e7e5", "g1f3"]
+
+
+def test_records_that_do_not_fit_are_skipped(tmp_path):
+    path = str(tmp_path / "session.bin")
+    record(path, "e2e4")
+    with open(path, "ab") as f:
+        f.write(pack_record(PLAY))  # No move
+        f.write(pack_record(PLAY, move=chess.Move.from_uci("a1a4")))  # Illegal
+        f.write(pack_record(99))  # Unknown op
+    record(path, "e7e5")
+    assert played(load_session(path)[-1]) == ["e2e4", "e7e5"]